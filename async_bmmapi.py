@@ -0,0 +1,129 @@
+import tempfile
+
+import aiohttp
+
+from bmmapi import BmmApiError, notAuthorized, notFound
+from metrics import metrics
+
+
+def assert_ok(response, allow_partial=False):
+    """assert_ok of bmmapi for aiohttp responses"""
+    if response.status == 200:
+        return True
+    if allow_partial and response.status == 206:
+        return True
+    if response.status == 403:
+        raise notAuthorized()
+    if response.status == 404:
+        raise notFound()
+    raise BmmApiError(
+        "request returned '{0}'. Expected '200 OK'".format(
+            response.status))
+
+
+class AsyncBmmApi:
+    """asyncio version of the MinimalBmmApi requests needed to send tracks.
+
+    Authentication(login, token cache and refresh) stays in the given MinimalBmmApi.
+    Its current token, default language and response cache are used for every request.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, bmm_api, session):
+        """
+        bmm_api: Authenticated MinimalBmmApi
+        session: aiohttp ClientSession whose connection pool is used for all requests
+        """
+        self.bmm_api = bmm_api
+        self.session = session
+        # Same meaning as the timeout of requests: seconds to connect and between received bytes
+        self.timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=bmm_api.timeout, sock_read=bmm_api.timeout)
+
+    def _get_headers(self, lang, extra_headers=None):
+        if lang is None:
+            lang = self.bmm_api.lang
+        else:
+            self.bmm_api._check_language(lang)
+        headers = {
+            'Accept': 'application/json',
+            'Accept-Language': lang,
+            'Authorization': f'Bearer {self.bmm_api.token}'
+        }
+        if extra_headers:
+            headers.update(extra_headers)
+        return headers
+
+    async def _get_json(self, path, lang=None, **kwargs):
+        """GET json response. Uses the response cache of bmm_api like MinimalBmmApi._get_json"""
+        response_cache = self.bmm_api.response_cache
+        cache_key = cached = None
+        extra_headers = {}
+        if response_cache:
+            cache_key = response_cache.get_key(path, lang or self.bmm_api.lang, kwargs)
+            cached = response_cache.get(cache_key)
+            if cached and cached.get('etag'):
+                extra_headers['If-None-Match'] = cached['etag']
+            if cached and cached.get('last_modified'):
+                extra_headers['If-Modified-Since'] = cached['last_modified']
+
+        async with self.session.get(
+                self.bmm_api.base_url + path,
+                params={key: str(value) for key, value in kwargs.items()},
+                headers=self._get_headers(lang, extra_headers),
+                timeout=self.timeout) as response:
+            if cached and response.status == 304:
+                return cached['data']
+            assert_ok(response)
+            data = await response.json(content_type=None)
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+        if response_cache and (etag or last_modified):
+            response_cache.set(cache_key, etag, last_modified, data)
+        return data
+
+    async def podcastTracks(self, id, lang=None, **params):
+        """Return tracks of podcast, newest first. See MinimalBmmApi.podcastTracks"""
+        with metrics.span('bmm_tracks', lang=lang or self.bmm_api.lang) as span:
+            tracks = await self._get_json('/podcast/{0}/track/'.format(id), lang=lang, **params)
+            span['tracks'] = len(tracks)
+        return tracks
+
+    async def podcastTracksSince(self, id, day, lang=None, page_size=10):
+        """Return tracks of podcast published on or after day('YYYY-MM-DD'), newest first.
+        See MinimalBmmApi.podcastTracksSince
+        """
+        tracks = []
+        offset = 0
+        while True:
+            page = await self.podcastTracks(id, lang=lang, **{'size': page_size, 'from': offset})
+            tracks.extend(page)
+            if len(page) < page_size or any(track['published_at'][:10] < day for track in page):
+                break
+            offset += page_size
+        return [track for track in tracks if track['published_at'][:10] >= day]
+
+    async def download_audio(self, url):
+        """Download audio into a temporary file and return it opened for reading.
+        Caller should close the returned file.
+        """
+        audio_file = tempfile.TemporaryFile()
+        try:
+            with metrics.span('audio_download') as span:
+                async with self.session.get(
+                        url,
+                        params={'auth': f'Bearer {self.bmm_api.token}'},
+                        timeout=self.timeout) as response:
+                    assert_ok(response)
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        audio_file.write(chunk)
+                span['bytes'] = audio_file.tell()
+                span['url'] = url
+            metrics.add('audio_download_bytes', audio_file.tell())
+        except BaseException:
+            audio_file.close()
+            raise
+        audio_file.seek(0)
+        return audio_file
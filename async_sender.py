@@ -0,0 +1,442 @@
+import sys
+import asyncio
+import functools
+import traceback
+from contextlib import asynccontextmanager
+
+from requests.exceptions import RequestException
+from requests.packages.urllib3.exceptions import ReadTimeoutError
+
+import settings
+from audio_prefetcher import AudioPrefetcher, download_audio
+from audio_relay import AudioRelay, open_audio_relay
+from metrics import metrics
+from telegram_bot import TelegramBot
+
+# Errors after which sending to a chat is tried again next time.
+# aiohttp.ClientError is added for the aiohttp engine.
+SEND_ERRORS = (RequestException, ReadTimeoutError, asyncio.TimeoutError)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Call blocking func(database, files, requests) in the default executor and return its result"""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def get_status_code(exc):
+    """Return HTTP status of the response of a failed request(requests or aiohttp error). None if there is none."""
+    response = getattr(exc, 'response', None)
+    if response is not None:
+        return response.status_code
+    return getattr(exc, 'status', None)
+
+
+class ExecutorClient:
+    """Async interface of a blocking client(MinimalBmmApi, TelegramBot). Every method call runs in the default executor.
+        bot = ExecutorClient(TelegramBot(...))
+        message = await bot.send_message('text', chat_id=...)
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        async def call(*args, **kwargs):
+            return await run_blocking(method, *args, **kwargs)
+        return call
+
+
+class AsyncFraKaareSender:
+    """Sending pipeline of FraKaareSender, on one asyncio event loop.
+
+    Tracks of all languages are listed concurrently, audio of the next tracks downloads while
+    the current one uploads and chats are sent to concurrently.
+
+    Requests are made by the engine of settings.ASYNC_ENGINE:
+        False: MinimalBmmApi and TelegramBot(requests) of the FraKaareSender, in the default executor
+        True: AsyncBmmApi and AsyncTelegramBot(aiohttp) on the event loop
+    Database, caches and files are used from the default executor, never on the event loop.
+
+    Database, file_id cache, lyrics catalogue, chats and the BMM login are those of the given
+    FraKaareSender, which runs this pipeline with asyncio.run(see FraKaareSender.run_async).
+    """
+
+    def __init__(self, sender, bmm_api, bot, engine='sync', send_errors=SEND_ERRORS):
+        """
+        sender: FraKaareSender
+        bmm_api: AsyncBmmApi, or ExecutorClient of the MinimalBmmApi of sender
+        bot: AsyncTelegramBot, or ExecutorClient of the TelegramBot of sender
+        engine: 'sync'(requests) or 'async'(aiohttp)
+        send_errors: Errors of the clients after which sending to a chat is tried again next time
+        """
+        self.sender = sender
+        self.bmm_api = bmm_api
+        self.bot = bot
+        self.engine = engine
+        self.send_errors = send_errors
+        self.db_man = sender.db_man
+        self.file_id_cache = sender.file_id_cache
+        self.lyrics_index = sender.lyrics_index
+        self.media_cache = sender.media_cache
+        self.chats = sender.chats
+        self.fan_out_workers = sender.fan_out_workers
+        self.audio_relay = sender.audio_relay
+        self.audio_relay_buffer_size = sender.audio_relay_buffer_size
+
+    @classmethod
+    @asynccontextmanager
+    async def open(cls, sender):
+        """Yield AsyncFraKaareSender of sender with the clients of the engine in settings.ASYNC_ENGINE"""
+        if not getattr(settings, 'ASYNC_ENGINE', False):
+            yield cls(sender, ExecutorClient(sender.bmm_api), ExecutorClient(sender.bot))
+            return
+
+        # aiohttp is only needed by this engine
+        import aiohttp
+        from async_bmmapi import AsyncBmmApi
+        from async_telegram_bot import AsyncTelegramBot
+
+        connector = aiohttp.TCPConnector(limit_per_host=getattr(settings, 'HTTP_POOL_SIZE', 8))
+        async with aiohttp.ClientSession(connector=connector) as session:
+            bot = AsyncTelegramBot(
+                sender.bot.bot_token,
+                session,
+                timeout=sender.bot.timeout,
+                upload_timeout=sender.bot.upload_timeout,
+                rate_limiter=sender.bot.rate_limiter,
+                max_retries=sender.bot.max_retries,
+                api_url=sender.bot.api_url,
+                local_mode=sender.bot.local_mode,
+            )
+            yield cls(
+                sender, AsyncBmmApi(sender.bmm_api, session), bot,
+                engine='async', send_errors=SEND_ERRORS + (aiohttp.ClientError,))
+
+    async def send_new_tracks(self):
+        """Look at the last sent day and send all the pending tracks"""
+        last_sent_day = await run_blocking(self.db_man.get_last_sent_day)
+        print(f'Last sent day: {last_sent_day}', flush=True)
+        new_tracks = await self.get_new_tracks(last_sent_day)
+        if not new_tracks:
+            print("No tracks to send", flush=True)
+            return
+        days_to_send = sorted(new_tracks.keys())
+        print(f"Days to send: {', '.join(days_to_send)}", flush=True)
+        # Download audio of next tracks(also of next days) while current one is uploading
+        prefetcher = await self.get_prefetcher(new_tracks, max_ahead=getattr(settings, 'AUDIO_PREFETCH', 2))
+        chats = self.chats
+        all_chats_sent = True
+        try:
+            for day in days_to_send:
+                day_chats = await run_blocking(self.sender.get_day_chats, day, chats)
+                print(f"Sending track of: {day}", end='', flush=True)
+                with metrics.span('send_day', engine=self.engine) as span:
+                    span['day'] = day
+                    failed_chat_ids = await self.send_tracks(new_tracks[day], prefetcher=prefetcher, chats=day_chats)
+                for chat in day_chats:
+                    if chat['chat_id'] not in failed_chat_ids:
+                        await run_blocking(self.db_man.set_last_sent_day, day, chat_id=chat['chat_id'])
+                if failed_chat_ids:
+                    print(f" - Fail(chats: {', '.join(map(str, failed_chat_ids))})", flush=True)
+                    all_chats_sent = False
+                    # Later days are not sent to failed chats to keep the order
+                    chats = [chat for chat in chats if chat['chat_id'] not in failed_chat_ids]
+                else:
+                    print(' - Success', flush=True)
+                # Day is sent when all chats have it
+                if all_chats_sent:
+                    await run_blocking(self.db_man.set_last_sent_day, day)
+                if not chats:
+                    break
+        finally:
+            await prefetcher.close()
+
+    async def get_new_tracks(self, last_sent_day):
+        """Return new tracks which have not yet been sent, as records of the track catalogue(see get_track_record).
+        [
+            '2019-25-11': {
+                'en': record,
+                'nb': record
+            },
+            ...
+        ]
+        """
+        page_size = getattr(settings, 'TRACKS_PAGE_SIZE', 10)
+
+        async def fetch_tracks(lang):
+            """Fetch only as many tracks as needed for last_sent_day"""
+            if last_sent_day is None:
+                return await self.bmm_api.podcastTracks(settings.PODCAST_ID, lang=lang, size=1)
+            if last_sent_day == '':
+                return await self.bmm_api.podcastTracks(settings.PODCAST_ID, lang=lang)
+            return await self.bmm_api.podcastTracksSince(
+                settings.PODCAST_ID, last_sent_day, lang=lang, page_size=page_size)
+
+        # Fetch tracks of all languages concurrently
+        tracks_by_lang = dict(zip(
+            settings.LANG,
+            await asyncio.gather(*[fetch_tracks(lang) for lang in settings.LANG])
+        ))
+        records_by_lang = await run_blocking(self.sender.catalogue_tracks, tracks_by_lang, last_sent_day)
+        return self.sender.group_new_tracks(records_by_lang, last_sent_day)
+
+    async def get_prefetcher(self, new_tracks, chats=None, max_ahead=2):
+        """Return AudioPrefetcher of the audio of new_tracks which needs to be uploaded to chats.
+        Relayed audio(settings.AUDIO_RELAY) is downloaded only while it is uploading, so nothing is prefetched.
+        """
+        urls = []
+        if not self.audio_relay:
+            urls = await run_blocking(self.sender.get_audio_urls_to_download, new_tracks, chats=chats)
+        return AudioPrefetcher(self.download_audio, urls, max_ahead=max_ahead)
+
+    async def download_audio(self, url):
+        """Download audio of url into a file. Read from(or download into) the media cache if there is one."""
+        if self.media_cache:
+            return await run_blocking(self.media_cache.open, url)
+        if self.engine == 'async':
+            return await self.bmm_api.download_audio(url)
+        return await run_blocking(download_audio, self.sender.bmm_api, url)
+
+    def _get_pending_chat_ids(self, day, chats, kind, lang='', failed_chat_ids=()):
+        """Return ids of chats which did not get kind(of lang) of day yet and did not fail. Reads the database."""
+        return [
+            chat['chat_id'] for chat in chats
+            if chat['chat_id'] not in failed_chat_ids
+            and not self.db_man.is_delivered(day, chat['chat_id'], kind, lang)
+        ]
+
+    async def send_tracks(self, tracks, prefetcher=None, chats=None):
+        """Download and send Fra Kåre tracks of a specific day to telegram chats.
+        Each chat gets the tracks of its languages. Audio is downloaded and uploaded once for all chats.
+        Audio, song header and lyrics messages which were already sent to a chat
+        (recorded in the database with their message ids) are skipped.
+        Audio is taken from prefetcher(AudioPrefetcher) if given. Else it is downloaded from BMM.
+        tracks: Records of the day by language(see get_new_tracks)
+        chats: Chats(see FraKaareSender.get_chats) to send to. Default is all chats.
+        Return:
+            List of chat_ids to which the tracks could not be sent
+        """
+        if chats is None:
+            chats = self.chats
+        all_chat_ids = [chat['chat_id'] for chat in chats]
+        failed_chat_ids = []
+        song_book = None
+        song_number = None
+        song_lyrics = {}
+        # Lyrics may have been rendered again since the last day
+        await run_blocking(self.lyrics_index.reload)
+        for lang in settings.LANG:
+            if not tracks.get(lang):
+                continue
+            day = tracks[lang]['day']
+            track_info = tracks[lang]
+            track_url = track_info['url']
+            track_title = track_info['title']
+
+            # There is no url. Silently skip sending this track.
+            if not track_url or not track_title:
+                return all_chat_ids
+
+            # Remove space as telegram adds random thumbnails and album arts otherwise
+            track_title_no_space = track_title.replace(' ', '_')
+            audio_caption = self.sender.get_track_caption(
+                track_info, add_song_info=False)
+
+            chat_ids = await run_blocking(
+                self._get_pending_chat_ids, day, [chat for chat in chats if lang in chat['lang']],
+                'audio', lang, failed_chat_ids)
+            if not chat_ids and prefetcher:
+                await prefetcher.discard(track_url)
+
+            # Send audio file
+            sent_messages = await self.send_audio(
+                track_url,
+                chat_ids,
+                prefetcher=prefetcher,
+                caption=audio_caption,
+                title=track_title_no_space,
+                parse_mode='HTML'
+            )
+            for chat_id in chat_ids:
+                if chat_id in sent_messages:
+                    await run_blocking(
+                        self.db_man.set_delivered,
+                        day, chat_id, 'audio', lang, message_ids=[sent_messages[chat_id]['message_id']])
+                else:
+                    failed_chat_ids.append(chat_id)
+
+            # Set song info
+            if not song_book:
+                song_book = track_info['song_book']
+                song_number = track_info['song_number']
+
+            # If lyrics of song are not in the catalogue, continue
+            lyrics = self.lyrics_index.get(song_book, lang, song_number)
+            if not lyrics:
+                continue
+            song_lyrics[lang] = lyrics
+
+        # No lyrics(also if no track of tracks is in LANG)
+        if not song_lyrics:
+            return failed_chat_ids
+
+        # Song lyrics in the languages of each chat
+        chat_lyrics = {}
+        for chat in chats:
+            lyrics_list = [
+                song_lyrics[lang] for lang in settings.LANG
+                if lang in chat['lang'] and lang in song_lyrics
+            ]
+            # If there is no song information for track, skip
+            if lyrics_list:
+                chat_lyrics[chat['chat_id']] = lyrics_list
+        lyrics_chat_ids = await run_blocking(
+            self._get_pending_chat_ids, day, [chat for chat in chats if chat['chat_id'] in chat_lyrics],
+            'lyrics', '', failed_chat_ids)
+
+        async def send_chat_lyrics(chat_id):
+            # Header is not sent again if only the lyrics failed last time
+            if not await run_blocking(self.db_man.is_delivered, day, chat_id, 'lyrics_header'):
+                message = await self.bot.send_message(
+                    text=f'<b>Song:</b> {song_book} {song_number}',
+                    chat_id=chat_id,
+                    parse_mode='HTML'
+                )
+                await run_blocking(
+                    self.db_man.set_delivered, day, chat_id, 'lyrics_header', message_ids=[message['message_id']])
+            messages = await self.send_lyrics(chat_lyrics[chat_id], chat_id=chat_id)
+            await run_blocking(
+                self.db_man.set_delivered,
+                day, chat_id, 'lyrics', message_ids=[message['message_id'] for message in messages])
+
+        # Send song lyrics. First chat uploads the images, the others get them by file_id.
+        failed_chat_ids.extend(await self._fan_out(lyrics_chat_ids[:1], send_chat_lyrics))
+        failed_chat_ids.extend(await self._fan_out(lyrics_chat_ids[1:], send_chat_lyrics))
+
+        return failed_chat_ids
+
+    async def _fan_out(self, chat_ids, send):
+        """Await send(chat_id) for all chat_ids concurrently, at most fan_out_workers at a time.
+        Return list of chat_ids for which sending failed.
+        """
+        semaphore = asyncio.Semaphore(max(self.fan_out_workers, 1))
+
+        async def send_limited(chat_id):
+            async with semaphore:
+                await send(chat_id)
+
+        results = await asyncio.gather(
+            *[send_limited(chat_id) for chat_id in chat_ids], return_exceptions=True)
+        failed_chat_ids = []
+        for chat_id, exc in zip(chat_ids, results):
+            if exc is None:
+                continue
+            if not isinstance(exc, self.send_errors):
+                raise exc
+            print(f'Sending to chat {chat_id} failed.', flush=True)
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+            sys.stdout.flush()
+            failed_chat_ids.append(chat_id)
+        return failed_chat_ids
+
+    async def send_audio(self, track_url, chat_ids, prefetcher=None, **kwargs):
+        """Send audio of track_url to all chat_ids.
+        The audio is sent to the first chat by its file_id if it was uploaded before.
+        Else it is uploaded and its file_id is remembered. All other chats get it by file_id concurrently.
+        Audio is relayed from BMM(AudioRelay) if settings.AUDIO_RELAY is True. If telegram asks to retry
+        the upload of relayed audio, it is downloaded and uploaded again.
+        Else it is taken from prefetcher(AudioPrefetcher) if given or downloaded from BMM.
+        kwargs are passed to TelegramBot.send_audio
+        Return:
+            Sent messages by chat_id. Chats which are missing could not be sent to.
+        """
+        sent_messages = {}
+        pending_chat_ids = list(chat_ids)
+        file_id = self.file_id_cache.get(track_url)
+        audio_file = None
+        relay = self.audio_relay
+        try:
+            while pending_chat_ids:
+                chat_id = pending_chat_ids[0]
+                try:
+                    if file_id:
+                        sent_messages[chat_id] = await self.bot.send_audio(file_id, chat_id=chat_id, **kwargs)
+                    else:
+                        if isinstance(audio_file, AudioRelay):
+                            # Relayed audio can be read only once. Relay it again.
+                            audio_file.close()
+                            audio_file = None
+                        if audio_file is None:
+                            if relay:
+                                audio_file = await run_blocking(
+                                    open_audio_relay, self.sender.bmm_api, track_url,
+                                    buffer_size=self.audio_relay_buffer_size)
+                            elif prefetcher:
+                                audio_file = await prefetcher.get(track_url)
+                            else:
+                                audio_file = await self.download_audio(track_url)
+                        audio_file.seek(0)
+                        sent_messages[chat_id] = await self.bot.send_audio(audio_file, chat_id=chat_id, **kwargs)
+                        file_id = TelegramBot.get_file_id(sent_messages[chat_id])
+                        await run_blocking(self.file_id_cache.set, track_url, file_id)
+                    pending_chat_ids.pop(0)
+                    break
+                except self.send_errors as exc:
+                    status_code = get_status_code(exc)
+                    if file_id and status_code == 400:
+                        # file_id is not accepted anymore. Upload again.
+                        await run_blocking(self.file_id_cache.remove, track_url)
+                        file_id = None
+                        continue
+                    if isinstance(audio_file, AudioRelay) and status_code == 429:
+                        # Relayed audio can not be sent again. It is sent again from a download,
+                        # after the pause telegram asked for.
+                        print(f'Telegram asked to retry. Downloading {track_url} to send it again.', flush=True)
+                        audio_file.close()
+                        audio_file = None
+                        relay = False
+                        continue
+                    traceback.print_exc()
+                    sys.stdout.flush()
+                    pending_chat_ids.pop(0)
+        finally:
+            if audio_file is not None:
+                audio_file.close()
+
+        async def send_file_id(chat_id):
+            sent_messages[chat_id] = await self.bot.send_audio(file_id, chat_id=chat_id, **kwargs)
+
+        await self._fan_out(pending_chat_ids, send_file_id)
+        return sent_messages
+
+    async def send_lyrics(self, lyrics_list, chat_id, use_file_ids=True):
+        """Send song lyrics images(see LyricsIndex.get) to telegram as a photo or media group.
+        Images which were uploaded before are sent by their file_id.
+        Return the sent messages.
+        """
+        media_list = []
+        try:
+            for lyrics in lyrics_list:
+                file_id = lyrics['file_id'] if use_file_ids else None
+                media_list.append(file_id or await run_blocking(open, lyrics['path'], 'rb'))
+            if len(media_list) > 1:
+                messages = await self.bot.send_media_group(media_list, chat_id=chat_id)
+            else:
+                messages = [await self.bot.send_photo(media_list[0], chat_id=chat_id)]
+        except self.send_errors as exc:
+            uses_file_ids = any(isinstance(media, str) for media in media_list)
+            if not uses_file_ids or get_status_code(exc) != 400:
+                raise
+            # Some file_id is not accepted anymore. Upload all images again.
+            return await self.send_lyrics(lyrics_list, chat_id, use_file_ids=False)
+        finally:
+            for media in media_list:
+                if not isinstance(media, str):
+                    media.close()
+
+        for lyrics, message in zip(lyrics_list, messages):
+            lyrics['file_id'] = TelegramBot.get_file_id(message)
+            await run_blocking(self.lyrics_index.set_file_id, lyrics, lyrics['file_id'])
+        return messages
@@ -0,0 +1,165 @@
+import os
+import json
+import asyncio
+
+import aiohttp
+
+from metrics import metrics
+from rate_limiter import RateLimiter
+from telegram_bot import get_error, get_local_uri
+
+
+class AsyncTelegramBot:
+    """asyncio version of TelegramBot.
+
+    Files are streamed to telegram from their file objects in chunks by aiohttp's multipart writer,
+    so uploading does not read whole files into memory.
+    Requests are rate limited and retried after '429 Too Many Requests' like those of TelegramBot.
+    `local_mode` sends files on disk by their path like TelegramBot.
+    """
+
+    def __init__(self, bot_token, session, timeout=15, upload_timeout=300, rate_limiter=None, max_retries=5,
+                 api_url='https://api.telegram.org', local_mode=False):
+        """
+        session: aiohttp ClientSession whose connection pool is used for all requests
+        timeout: Timeout in seconds of requests which do not upload files
+        upload_timeout: Timeout in seconds of requests which upload files
+        rate_limiter: RateLimiter shared by all requests(e.g. the one of TelegramBot)
+        max_retries: Times a request is sent again after '429 Too Many Requests'
+        api_url: Base url of the bot api
+        local_mode: Send files on disk by their path. Only for a local bot api server started with --local.
+        """
+        self.bot_token = bot_token
+        self.api_url = api_url.rstrip('/')
+        self.session = session
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+        self.upload_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=upload_timeout)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.local_mode = local_mode
+
+    @staticmethod
+    def _get_form(data, files):
+        form = aiohttp.FormData()
+        for name, value in data.items():
+            # Like requests, leave out fields without value
+            if value is not None:
+                form.add_field(name, str(value))
+        for name, file in files.items():
+            file_name = getattr(file, 'name', None)
+            file_name = os.path.basename(file_name) if isinstance(file_name, str) else name
+            form.add_field(name, file, filename=file_name)
+        return form
+
+    async def _post(self, method, data, files=None):
+        """Call given bot api method"""
+        with metrics.span('telegram_request', method=method, upload=bool(files)) as span:
+            span['chat_id'] = data.get('chat_id')
+            return await self._post_retrying(method, data, files or {}, span)
+
+    async def _post_retrying(self, method, data, files, span):
+        """Call given bot api method. Wait for the rate limiter and send again after '429 Too Many Requests'."""
+        url = f'{self.api_url}/bot{self.bot_token}/{method}'
+        chat_id = data.get('chat_id')
+        # Files are read again from their start if the request is retried
+        file_positions = {name: file.tell() for name, file in files.items()}
+        # Files which can not be rewound(e.g. AudioRelay) can be sent only once
+        can_retry = all(getattr(file, 'seekable', lambda: True)() for file in files.values())
+        for try_ind in range(self.max_retries + 1):
+            wait_time = self.rate_limiter.reserve(chat_id)
+            span['wait_seconds'] = round(span.get('wait_seconds', 0) + wait_time, 3)
+            span['tries'] = try_ind + 1
+            if wait_time:
+                await asyncio.sleep(wait_time)
+            for name, position in file_positions.items():
+                files[name].seek(position)
+            async with self.session.post(
+                    url, data=self._get_form(data, files),
+                    timeout=self.upload_timeout if files else self.timeout) as response:
+                try:
+                    response_json = await response.json(content_type=None)
+                except ValueError:
+                    response_json = None
+                if response.status == 200:
+                    return response_json['result']
+            description, retry_after = get_error(response_json)
+            if response.status != 429 or retry_after is None:
+                break
+            # Later requests wait too, also if this one is not sent again
+            self.rate_limiter.pause(chat_id, retry_after)
+            if try_ind == self.max_retries or not can_retry:
+                break
+            print(f'Telegram {method}: retry after {retry_after} seconds', flush=True)
+            metrics.add('telegram_retries', method=method)
+        raise aiohttp.ClientResponseError(
+            response.request_info, response.history, status=response.status,
+            message=f'{description or response.reason} for {method}', headers=response.headers)
+
+    def _add_input_file(self, name, media, data, files):
+        """Add media to request. media is either a byte stream to upload or file_id of an uploaded file.
+        In local mode, files on disk are sent by their path.
+        """
+        if self.local_mode:
+            media = get_local_uri(media) or media
+        if isinstance(media, str):
+            data[name] = media
+        else:
+            files[name] = media
+
+    async def send_message(self, text, chat_id, parse_mode=None):
+        """Send a text message. Return the sent message."""
+        data = {
+            'chat_id': chat_id,
+            'text': text,
+            'parse_mode': parse_mode,
+        }
+        return await self._post('sendMessage', data)
+
+    async def send_audio(self, audio_stream, chat_id, caption=None, title=None, parse_mode=None, performer=None):
+        """Send given audio byte stream(or file_id) to given chat_id. Return the sent message."""
+        files = {}
+        data = {
+            'chat_id': chat_id,
+            'caption': caption,
+            'title': title,
+            'parse_mode': parse_mode,
+            'performer': performer
+        }
+        self._add_input_file('audio', audio_stream, data, files)
+        return await self._post('sendAudio', data, files=files)
+
+    async def send_photo(self, photo_stream, chat_id, caption=None, parse_mode=None):
+        """Send given photo byte stream(or file_id) to given chat_id. Return the sent message."""
+        files = {}
+        data = {
+            'chat_id': chat_id,
+            'caption': caption,
+            'parse_mode': parse_mode,
+        }
+        self._add_input_file('photo', photo_stream, data, files)
+        return await self._post('sendPhoto', data, files=files)
+
+    async def send_media_group(self, media_list, chat_id):
+        """Send given list of photos(byte streams or file_ids) given chat_id.
+        Return list of the sent messages.
+        """
+        files = {}
+        data = {
+            'chat_id': chat_id,
+            'media': [],
+        }
+        for index, media in enumerate(media_list):
+            if self.local_mode:
+                media = get_local_uri(media) or media
+            if isinstance(media, str):
+                media_ref = media
+            else:
+                attach_id = f'media_{index}'
+                media_ref = f'attach://{attach_id}'
+                files[attach_id] = media
+            data['media'].append({
+                'type': 'photo',
+                'media': media_ref,
+            })
+        data['media'] = json.dumps(data['media'])
+        return await self._post('sendMediaGroup', data, files=files)
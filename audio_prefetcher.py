@@ -0,0 +1,103 @@
+import shutil
+import asyncio
+import tempfile
+from collections import OrderedDict
+
+from metrics import metrics
+
+
+def download_audio(bmm_api, url, spool_size=16 * 1024 * 1024, media_cache=None):
+    """Download audio and return it as a file opened for reading.
+    If media_cache(MediaCache) is given, audio is read from(or downloaded into) it.
+    Else it is downloaded into a temporary file.
+    Audio bigger than spool_size(bytes) is kept on disk instead of memory.
+    """
+    if media_cache:
+        return media_cache.open(url)
+    audio_file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    try:
+        with metrics.span('audio_download') as span:
+            # Raw bytes are copied. Encoded(compressed) responses would be copied encoded.
+            response = bmm_api.get_response_object(url, headers={'Accept-Encoding': 'identity'})
+            try:
+                shutil.copyfileobj(response.raw, audio_file)
+            finally:
+                response.close()
+            span['bytes'] = audio_file.tell()
+            span['url'] = url
+        metrics.add('audio_download_bytes', audio_file.tell())
+    except BaseException:
+        audio_file.close()
+        raise
+    audio_file.seek(0)
+    return audio_file
+
+
+class AudioPrefetcher:
+    """Download audio of tracks ahead of sending them, as tasks on the running event loop.
+
+    Urls are downloaded in the order in which they will be sent.
+    At most `max_ahead` audio files are downloading or waiting to be sent at a time,
+    so memory/disk usage stays bounded however many tracks are pending.
+
+    Usage(see AsyncFraKaareSender.download_audio):
+        prefetcher = AudioPrefetcher(async_sender.download_audio, urls)
+        with await prefetcher.get(urls[0]) as audio_file:
+            await bot.send_audio(audio_file, ...)
+        await prefetcher.close()
+    """
+
+    def __init__(self, download, urls, max_ahead=2):
+        """
+        download: Coroutine function returning the downloaded audio file of a url
+        urls: Audio urls in the order in which they will be sent
+        max_ahead: Maximum number of audio files downloaded ahead
+        """
+        self.download = download
+        self.max_ahead = max(max_ahead, 1)
+        self.pending_urls = [url for url in urls if url]
+        self.tasks = OrderedDict()
+        self._fill()
+
+    def _fill(self):
+        """Start downloads until max_ahead downloads are in flight"""
+        while self.pending_urls and len(self.tasks) < self.max_ahead:
+            url = self.pending_urls.pop(0)
+            if url in self.tasks:
+                continue
+            self.tasks[url] = asyncio.ensure_future(self.download(url))
+
+    async def get(self, url):
+        """Return downloaded audio file of url. Wait if it is still downloading.
+        Caller should close the returned file.
+        """
+        task = self.tasks.pop(url, None)
+        if task is None:
+            # Url was not expected yet. Download it now.
+            task = asyncio.ensure_future(self.download(url))
+        self._fill()
+        return await task
+
+    @staticmethod
+    async def _close_task(task):
+        """Cancel download or close its audio file if it is done"""
+        task.cancel()
+        result, = await asyncio.gather(task, return_exceptions=True)
+        if not isinstance(result, BaseException):
+            result.close()
+
+    async def discard(self, url):
+        """Drop audio of url which is not going to be sent"""
+        if url in self.pending_urls:
+            self.pending_urls.remove(url)
+        task = self.tasks.pop(url, None)
+        if task is not None:
+            await self._close_task(task)
+        self._fill()
+
+    async def close(self):
+        """Cancel pending downloads and discard audio which was not sent"""
+        self.pending_urls = []
+        for task in self.tasks.values():
+            await self._close_task(task)
+        self.tasks.clear()
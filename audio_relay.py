@@ -0,0 +1,162 @@
+import io
+import threading
+import time
+
+from requests.exceptions import RequestException
+
+from metrics import metrics
+
+
+class AudioRelayError(RequestException):
+    """Download of relayed audio failed. Handled like other network errors."""
+    pass
+
+
+class AudioRelay(io.RawIOBase):
+    """Audio which is uploaded while it is downloaded, through a fixed size ring buffer.
+
+    A background thread reads the BMM response straight into free space of the buffer and
+    waits while the buffer is full(backpressure), so the download runs at most buffer_size
+    bytes ahead of the upload. Memory stays the same whatever the length of the track.
+
+    It is read like a file(e.g. by MultipartEncoder or aiohttp) but only once: it can not be rewound,
+    so a request which telegram asks to retry(429) must be sent from a download instead.
+
+    Usage:
+        relay = open_audio_relay(bmm_api, url)
+        bot.send_audio(relay, chat_id=...)
+        relay.close()
+    """
+
+    def __init__(self, response, buffer_size=1024 * 1024, url=None):
+        """
+        response: Streamed requests response of the audio
+        buffer_size: Bytes of the ring buffer
+        url: Url of the audio. Only used for logging.
+        """
+        super().__init__()
+        self.response = response
+        self.url = url
+        content_length = response.headers.get('Content-Length')
+        # Size of the audio. None if not known.
+        self.len = int(content_length) if content_length else None
+        self.bytes_read = 0
+        self.bytes_downloaded = 0
+        self.start_time = time.monotonic()
+
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._count = 0
+        self._finished = False
+        self._closed = False
+        self._error = None
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._download, daemon=True)
+        self._thread.start()
+
+    @property
+    def bytes_per_second(self):
+        """Average upload speed so far"""
+        seconds = time.monotonic() - self.start_time
+        return self.bytes_read / seconds if seconds > 0 else 0.0
+
+    @property
+    def progress(self):
+        """Part of the audio read so far(0 to 1). None if the size is not known."""
+        if not self.len:
+            return None
+        return self.bytes_read / self.len
+
+    def _get_free_space(self):
+        """Return (position, size) of the free space after the buffered bytes. Wait while the buffer is full."""
+        with self._condition:
+            while self._count == len(self._buffer) and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return None, 0
+            end = (self._start + self._count) % len(self._buffer)
+            # Only up to the end of the buffer. The rest is filled on the next round.
+            if end >= self._start:
+                return end, len(self._buffer) - end
+            return end, self._start - end
+
+    def _download(self):
+        raw = self.response.raw
+        try:
+            with metrics.span('audio_download', relay=True) as span:
+                while True:
+                    position, size = self._get_free_space()
+                    if not size:
+                        break
+                    # Bytes are read into free space of the buffer, so no chunks pile up in between.
+                    # urllib3 copies them once on the way(its readinto calls read()).
+                    read_size = raw.readinto(self._view[position:position + size])
+                    if not read_size:
+                        break
+                    self.bytes_downloaded += read_size
+                    with self._condition:
+                        self._count += read_size
+                        self._condition.notify_all()
+                span['bytes'] = self.bytes_downloaded
+                span['url'] = self.url
+            metrics.add('audio_download_bytes', self.bytes_downloaded)
+            if not self._closed and self.len is not None and self.bytes_downloaded != self.len:
+                raise AudioRelayError(f'Downloaded {self.bytes_downloaded} bytes of {self.len} bytes from {self.url}')
+        except Exception as exc:
+            self._error = exc
+        finally:
+            self.response.close()
+            with self._condition:
+                self._finished = True
+                self._condition.notify_all()
+
+    def read(self, size=-1):
+        """Return next size bytes(all remaining bytes if size is negative). Wait until they are downloaded.
+        b'' at the end of the audio.
+        """
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(len(self._buffer)), b''))
+        with self._condition:
+            while not self._count and not self._finished and not self._closed:
+                self._condition.wait()
+            if self._error is not None and not self._count:
+                if isinstance(self._error, RequestException):
+                    raise self._error
+                raise AudioRelayError(f'Download of {self.url} failed: {self._error}') from self._error
+            size = min(size, self._count, len(self._buffer) - self._start)
+            data = bytes(self._view[self._start:self._start + size])
+            self._start = (self._start + size) % len(self._buffer)
+            self._count -= size
+            self.bytes_read += size
+            self._condition.notify_all()
+        return data
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_read
+
+    def seekable(self):
+        return False
+
+    def seek(self, offset, whence=0):
+        """Only seeking to the current position is possible"""
+        if whence != 0 or offset != self.bytes_read:
+            raise OSError('Relayed audio can not be rewound')
+        return self.bytes_read
+
+    def close(self):
+        """Stop downloading. The download thread closes the response after its current read."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        super().close()
+
+
+def open_audio_relay(bmm_api, url, buffer_size=1024 * 1024):
+    """Start downloading audio of url and return it as AudioRelay"""
+    # Bytes are relayed as they are sent. Encoded(compressed) responses would be sent encoded.
+    response = bmm_api.get_response_object(url, headers={'Accept-Encoding': 'identity'})
+    return AudioRelay(response, buffer_size=buffer_size, url=url)
@@ -0,0 +1,209 @@
+import os
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+from async_sender import run_blocking
+from fra_kaare_sender import FraKaareSender
+from metrics import metrics
+
+
+class Backfiller:
+    """Send the history of the podcast(all of it or some days) to chats, e.g. to seed a new channel.
+
+    Tracks are listed from BMM into the track catalogue(TrackCatalogue) of the sender. Days which
+    the catalogue already has are not listed again, only tracks published since the last listing.
+
+    Days are sent oldest first with AsyncFraKaareSender.send_tracks, so uploads are rate limited and each
+    audio is uploaded once for all chats. Audio of the next days is downloaded in parallel(into the
+    media cache if enabled) while the current day is uploading.
+
+    Every sent message is journaled in the database(deliveries table), which is the checkpoint:
+    a backfill which is started again after an interruption skips everything which was sent.
+    The last sent day of the daily sender is not changed.
+    """
+
+    def __init__(self, sender, langs=None, chat_ids=None, from_day=None, to_day=None, songs=None, downloads=4,
+                 page_size=100):
+        """
+        sender: FraKaareSender whose bot, database and caches are used
+        langs: Languages to send. Default is settings.LANG.
+        chat_ids: Chats to send to. Default is all chats(see FraKaareSender.get_chats).
+                  Chats which are not in the settings get all langs.
+        from_day, to_day: First and last day('YYYY-MM-DD') to send. Default is from the first and to the last track.
+        songs: Only send days whose track has one of these songs, e.g. [('HV', 12)]. Default is all days.
+        downloads: Audio files downloaded in parallel ahead of sending
+        page_size: Tracks listed per request
+        """
+        self.sender = sender
+        self.langs = [lang for lang in settings.LANG if langs is None or lang in langs]
+        self.from_day = from_day
+        self.to_day = to_day
+        self.songs = songs
+        self.downloads = downloads
+        self.page_size = page_size
+        self.chats = self.get_chats(chat_ids)
+
+    def get_chats(self, chat_ids=None):
+        """Return chats(see FraKaareSender.get_chats) to send to, with only the languages to send"""
+        chats = self.sender.chats
+        if chat_ids is not None:
+            chats_by_id = {str(chat['chat_id']): chat for chat in chats}
+            chats = [chats_by_id.get(str(chat_id), {'chat_id': chat_id, 'lang': self.langs}) for chat_id in chat_ids]
+        chats = [
+            {'chat_id': chat['chat_id'], 'lang': [lang for lang in chat['lang'] if lang in self.langs]}
+            for chat in chats
+        ]
+        return [chat for chat in chats if chat['lang']]
+
+    def get_tracks(self):
+        """Return records of tracks from from_day to to_day by day, like AsyncFraKaareSender.get_new_tracks"""
+        track_catalogue = self.sender.track_catalogue
+
+        def update_catalogue(lang):
+            """List tracks of lang which are not in the catalogue yet"""
+            since = track_catalogue.get_sync_day(lang, self.from_day or '')
+            tracks = self.sender.bmm_api.podcastTracksSince(
+                settings.PODCAST_ID, since, lang=lang, page_size=self.page_size)
+            track_catalogue.add_tracks(lang, tracks, since=since)
+
+        # List tracks of all languages in parallel
+        with ThreadPoolExecutor(max_workers=max(len(self.langs), 1)) as executor:
+            list(executor.map(update_catalogue, self.langs))
+        tracks = track_catalogue.get_tracks(self.langs, self.from_day, self.to_day)
+        if self.songs is not None:
+            song_days = {
+                day for song_book, song_number in self.songs
+                for day in track_catalogue.get_song_days(song_book, song_number, self.langs)
+            }
+            tracks = {day: day_tracks for day, day_tracks in tracks.items() if day in song_days}
+        return tracks
+
+    def is_sent(self, day, day_tracks, chat):
+        """Return True if audio of all languages of chat and the lyrics(if any) of day were sent to chat"""
+        db_man = self.sender.db_man
+        chat_langs = [lang for lang in chat['lang'] if day_tracks.get(lang)]
+        if not all(db_man.is_delivered(day, chat['chat_id'], 'audio', lang) for lang in chat_langs):
+            return False
+        has_lyrics = any(
+            self.sender.lyrics_index.get(day_tracks[lang]['song_book'], lang, day_tracks[lang]['song_number'])
+            for lang in chat_langs
+        )
+        return not has_lyrics or db_man.is_delivered(day, chat['chat_id'], 'lyrics')
+
+    def get_pending_days(self, tracks):
+        """Return days which were not sent to some chat, oldest first"""
+        return [
+            day for day in sorted(tracks)
+            if any(not self.is_sent(day, tracks[day], chat) for chat in self.chats)
+        ]
+
+    def run(self, dry_run=False):
+        """Send all pending days. Return True if everything was sent."""
+        tracks = self.get_tracks()
+        pending_days = self.get_pending_days(tracks)
+        print(f'{len(tracks)} days to backfill to {len(self.chats)} chats'
+              f"({', '.join(self.langs)}). {len(pending_days)} days not sent yet.", flush=True)
+        if dry_run:
+            for day in pending_days:
+                print(f"{day}: {', '.join(sorted(tracks[day]))}")
+            return not pending_days
+        if not pending_days:
+            return True
+
+        try:
+            return self.sender.run_async(lambda async_sender: self.send_days(async_sender, tracks, pending_days))
+        except KeyboardInterrupt:
+            print('Interrupted. Run again to continue.', flush=True)
+            return False
+        finally:
+            metrics.write_textfile()
+
+    async def send_days(self, async_sender, tracks, days):
+        """Send tracks of days with async_sender(AsyncFraKaareSender). Return True if all chats got all days."""
+        prefetcher = await async_sender.get_prefetcher(
+            {day: tracks[day] for day in days}, chats=self.chats, max_ahead=self.downloads)
+        chats = self.chats
+        start_time = time.monotonic()
+        try:
+            for index, day in enumerate(days, 1):
+                day_chats = [chat for chat in chats if not await run_blocking(self.is_sent, day, tracks[day], chat)]
+                with metrics.span('backfill_day') as span:
+                    span['day'] = day
+                    failed_chat_ids = await async_sender.send_tracks(tracks[day], prefetcher=prefetcher, chats=day_chats)
+                if failed_chat_ids:
+                    print(f"{day}: Fail(chats: {', '.join(map(str, failed_chat_ids))})", flush=True)
+                    # Later days are not sent to failed chats to keep the order
+                    chats = [chat for chat in chats if chat['chat_id'] not in failed_chat_ids]
+                    if not chats:
+                        break
+
+                seconds = time.monotonic() - start_time
+                eta = timedelta(seconds=round(seconds / index * (len(days) - index)))
+                print(f'{day}: {index}/{len(days)} days({index / len(days):.1%}) '
+                      f'in {timedelta(seconds=round(seconds))}, ETA {eta}', flush=True)
+        finally:
+            await prefetcher.close()
+        return chats == self.chats
+
+
+def get_day(value):
+    """argparse type of 'YYYY-MM-DD'"""
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a day(YYYY-MM-DD)")
+    return value
+
+
+def get_song(value):
+    """argparse type of 'BOOK-NUMBER', e.g. 'HV-12'. Return (book, number)."""
+    song_book, _, song_number = value.rpartition('-')
+    if not song_book or not song_number.isdigit():
+        raise argparse.ArgumentTypeError(f"'{value}' is not a song(BOOK-NUMBER, e.g. HV-12)")
+    return song_book, int(song_number)
+
+
+def get_args():
+    """Parse and return command line arguments"""
+    arg_parser = argparse.ArgumentParser(description='Send the history of the podcast to telegram chats')
+    arg_parser.add_argument('--from', dest='from_day', type=get_day, help='first day to send(YYYY-MM-DD)')
+    arg_parser.add_argument('--to', dest='to_day', type=get_day, help='last day to send(YYYY-MM-DD)')
+    arg_parser.add_argument(
+        '-l', '--lang', action='append', help='language to send(can be repeated). Default is all of LANG.')
+    arg_parser.add_argument(
+        '-c', '--chat', action='append',
+        help='chat id to send to(can be repeated). Default is all chats of the settings.')
+    arg_parser.add_argument(
+        '-s', '--song', action='append', type=get_song,
+        help='only send days whose track has this song(BOOK-NUMBER, e.g. HV-12, can be repeated)')
+    arg_parser.add_argument(
+        '-j', '--downloads', type=int, default=4, help='audio files downloaded in parallel(default 4)')
+    arg_parser.add_argument('-n', '--dry-run', action='store_true', help='only list the days which would be sent')
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    settings.SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+    unknown_langs = set(args.lang or []) - set(settings.LANG)
+    if unknown_langs:
+        sys.exit(f"Languages {', '.join(sorted(unknown_langs))} are not in LANG of the settings")
+    metrics.configure(
+        log_file=getattr(settings, 'METRICS_LOG', None),
+        textfile=getattr(settings, 'METRICS_TEXTFILE', None),
+    )
+
+    backfiller = Backfiller(
+        FraKaareSender(),
+        langs=args.lang,
+        chat_ids=args.chat,
+        from_day=args.from_day,
+        to_day=args.to_day,
+        songs=args.song,
+        downloads=args.downloads,
+    )
+    sys.exit(0 if backfiller.run(dry_run=args.dry_run) else 1)
@@ -0,0 +1,275 @@
+"""Benchmark sending of tracks without network.
+
+Local stand-ins of BMM and telegram(fake_servers.py) are started and FraKaareSender
+sends the tracks of a scenario to them once(try_send_new_tracks). Each scenario runs in
+a new process with its own settings and state directory, so its peak memory is its own.
+
+Usage:
+    python bench/benchmark.py                              # All scenarios with both engines
+    python bench/benchmark.py -s daily -e sync --latency 0.05 --bandwidth 2000000
+    python bench/benchmark.py -s daily --login pkce      # Log in to a fake identity provider first
+"""
+import os
+import sys
+import json
+import time
+import types
+import ast
+import argparse
+import resource
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+from fake_servers import FakeBmmServer, FakeIdpServer, FakeTelegramServer
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+MB = 1024 * 1024
+ALL_LANGS = ['de', 'en', 'es', 'fi', 'fr', 'hu', 'it', 'nb', 'nl', 'pl', 'pt', 'ro', 'ru', 'sl', 'ta', 'tr']
+
+SCENARIOS = {
+    # Usual morning: today's track in 2 languages to one chat
+    'daily': {'days': 1, 'langs': ['en', 'nb'], 'chats': 1, 'audio_size': 8 * MB},
+    # A month was missed: 30 days in all languages, each language to its own chat
+    'catch_up': {'days': 30, 'langs': ALL_LANGS, 'chats': 16, 'audio_size': 1 * MB},
+    # One very large audio file
+    'large_audio': {'days': 1, 'langs': ['en'], 'chats': 1, 'audio_size': 100 * MB},
+    # One day to many chats, which get the audio by file_id
+    'fan_out': {'days': 1, 'langs': ['en', 'nb'], 'chats': 20, 'audio_size': 8 * MB},
+}
+LYRICS_IMAGE_SIZE = 100 * 1024
+IDP_CLIENT_ID = 'bench-client'
+IDP_REDIRECT_URI = 'http://localhost/callback'
+
+
+def get_days(count):
+    """Return the last count weekdays(Mon-Fri), oldest first.
+    The newest is the day FraKaareSender.get_last_weekday expects today.
+    """
+    day = datetime.now()
+    days = []
+    while len(days) < count:
+        if day.weekday() < 5:
+            days.append(day.strftime('%Y-%m-%d'))
+        day -= timedelta(days=1)
+    return sorted(days)
+
+
+def get_chats(langs, chat_count):
+    """Every chat gets all languages if there is one chat, else one language each(round robin)"""
+    if chat_count == 1:
+        return [{'chat_id': 'chat-1', 'lang': list(langs)}]
+    return [
+        {'chat_id': f'chat-{index + 1}', 'lang': [langs[index % len(langs)]]}
+        for index in range(chat_count)
+    ]
+
+
+def write_lyrics_catalogue(song_lyrics_dir, langs, song_numbers):
+    """Write lyrics images of LYRICS_IMAGE_SIZE bytes and their catalogue(see LyricsIndex)"""
+    catalogue = {'HV': {}}
+    image = b'\x89PNG\r\n\x1a\n' + b'\0' * (LYRICS_IMAGE_SIZE - 8)
+    for lang in langs:
+        os.makedirs(os.path.join(song_lyrics_dir, f'HV-{lang}'), exist_ok=True)
+        catalogue['HV'][lang] = {}
+        for song_number in song_numbers:
+            file_name = f'HV-{lang}/{song_number}.png'
+            with open(os.path.join(song_lyrics_dir, file_name), 'wb') as image_file:
+                image_file.write(image)
+            catalogue['HV'][lang][str(song_number)] = {'file': file_name, 'size': len(image), 'sha256': None}
+    with open(os.path.join(song_lyrics_dir, 'catalogue.json'), 'w') as catalogue_file:
+        json.dump(catalogue, catalogue_file)
+
+
+def get_peak_rss_mb():
+    """Peak resident memory of this process in MB.
+    ru_maxrss can include the memory of the parent before exec, so VmHWM of linux is preferred.
+    """
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Kilobytes on linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_child(config):
+    """Send tracks of config with settings pointing to the fake servers. Return the results."""
+    state_dir = config['state_dir']
+    if not config['login']:
+        with open(os.path.join(state_dir, 'token.json'), 'w') as token_file:
+            json.dump({'access_token': 'bench-token', 'expires_at': int(time.time()) + 24 * 3600}, token_file)
+    if config['lyrics']:
+        write_lyrics_catalogue(
+            os.path.join(state_dir, 'song_lyrics'), config['langs'], range(1, config['days'] + 1))
+
+    settings = types.ModuleType('settings')
+    settings.__dict__.update({
+        'SCRIPT_DIR': state_dir,
+        'BMM_USERNAME': 'bench',
+        'BMM_PASSWORD': 'bench',
+        'PODCAST_ID': 54,
+        'BMM_API_URL': config['bmm_url'],
+        'TELEGRAM_API_URL': config['telegram_url'],
+        'TELEGRAM_BOT_TOKEN': 'bench-token',
+        'TELEGRAM_CHATS': config['chats'],
+        'LANG': config['langs'],
+        'ASYNC_ENGINE': config['engine'] == 'async',
+    })
+    if not config['rate_limits']:
+        # Only the sender itself is measured
+        settings.__dict__.update({'TELEGRAM_RATE': 1e6, 'TELEGRAM_CHAT_RATE': 1e6, 'TELEGRAM_CHAT_BURST': 1e6})
+    if config['login']:
+        # Only the login without a browser is measured
+        settings.__dict__.update({
+            'BMM_LOGIN_FLOW': config['login'],
+            'BMM_TOKEN_URL': config['idp_url'] + '/oauth/token',
+            'BMM_AUTHORIZE_URL': config['idp_url'] + '/authorize',
+            'BMM_REDIRECT_URI': IDP_REDIRECT_URI,
+            'BMM_CLIENT_ID': IDP_CLIENT_ID,
+            'BMM_BROWSER_LOGIN': False,
+        })
+    settings.__dict__.update(config['settings'])
+    sys.modules['settings'] = settings
+
+    sys.path.insert(0, REPO_DIR)
+    from fra_kaare_sender import FraKaareSender
+
+    start_time = time.perf_counter()
+    sender = FraKaareSender(try_times=1)
+    startup_seconds = time.perf_counter() - start_time
+    last_sent_day = datetime.strptime(config['first_day'], '%Y-%m-%d') - timedelta(days=1)
+    sender.db_man.set_last_sent_day(last_sent_day.strftime('%Y-%m-%d'))
+
+    start_rss_mb = get_peak_rss_mb()
+    start_time = time.perf_counter()
+    sender.try_send_new_tracks()
+    seconds = time.perf_counter() - start_time
+    return {
+        'startup_seconds': startup_seconds,
+        'seconds': seconds,
+        'sent': not sender._are_tracks_pending(),
+        'start_rss_mb': start_rss_mb,
+        'peak_rss_mb': get_peak_rss_mb(),
+    }
+
+
+def run_scenario(name, engine, args):
+    """Start fake servers, send tracks of scenario in a child process and return its results"""
+    scenario = SCENARIOS[name]
+    days = get_days(scenario['days'])
+    bmm = FakeBmmServer(days, scenario['audio_size'], latency=args.latency, bandwidth=args.bandwidth).start()
+    telegram = FakeTelegramServer(latency=args.latency).start()
+    idp = FakeIdpServer('bench', 'bench', IDP_CLIENT_ID, IDP_REDIRECT_URI, latency=args.latency).start()
+    try:
+        with tempfile.TemporaryDirectory(prefix='fra-kaare-bench-') as state_dir:
+            config = {
+                'state_dir': state_dir,
+                'bmm_url': bmm.url,
+                'telegram_url': telegram.url,
+                'idp_url': idp.url,
+                'login': args.login,
+                'engine': engine,
+                'langs': scenario['langs'],
+                'chats': get_chats(scenario['langs'], scenario['chats']),
+                'days': scenario['days'],
+                'first_day': days[0],
+                'lyrics': not args.no_lyrics,
+                'rate_limits': args.rate_limits,
+                'settings': dict(args.setting),
+            }
+            result_path = os.path.join(state_dir, 'result.json')
+            output = None if args.verbose else subprocess.DEVNULL
+            subprocess.run(
+                [sys.executable, os.path.realpath(__file__), '--child', json.dumps(config), '--result', result_path],
+                stdout=output, stderr=output, check=True)
+            with open(result_path) as result_file:
+                result = json.load(result_file)
+    finally:
+        bmm.stop()
+        telegram.stop()
+        idp.stop()
+
+    result.update({
+        'scenario': name,
+        'engine': engine,
+        'downloaded_mb': bmm.bytes_sent / MB,
+        'uploaded_mb': telegram.bytes_received / MB,
+        'bmm_requests': bmm.requests,
+        'telegram_requests': telegram.requests,
+    })
+    return result
+
+
+def print_results(results):
+    columns = [
+        ('scenario', '{:<12}'), ('engine', '{:<6}'), ('sent', '{!s:<5}'), ('startup_seconds', '{:>15.2f}'),
+        ('seconds', '{:>8.2f}'),
+        ('peak_rss_mb', '{:>11.1f}'), ('downloaded_mb', '{:>13.1f}'), ('uploaded_mb', '{:>11.1f}'),
+        ('bmm_requests', '{:>12}'), ('telegram_requests', '{:>17}'),
+    ]
+    print(' '.join(fmt.replace('.2f', '').replace('.1f', '').replace('!s', '').format(name) for name, fmt in columns))
+    for result in results:
+        print(' '.join(fmt.format(result[name]) for name, fmt in columns))
+
+
+def parse_setting(value):
+    """NAME=VALUE with VALUE as python literal(or string)"""
+    name, _, value = value.partition('=')
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return name, value
+
+
+def get_args():
+    """Parse and return command line arguments"""
+    arg_parser = argparse.ArgumentParser(description='Benchmark sending tracks against local fake servers')
+    arg_parser.add_argument(
+        '-s', '--scenario', action='append', choices=sorted(SCENARIOS),
+        help='scenario to run(can be repeated). Default is all.')
+    arg_parser.add_argument(
+        '-e', '--engine', action='append', choices=['sync', 'async'],
+        help='sending engine(can be repeated). Default is both.')
+    arg_parser.add_argument(
+        '--latency', type=float, default=0.0, help='seconds every fake server response is delayed')
+    arg_parser.add_argument(
+        '--bandwidth', type=float, default=None, help='audio download bandwidth in bytes per second')
+    arg_parser.add_argument(
+        '--rate-limits', action='store_true',
+        help="keep telegram's rate limits(settings defaults). Disabled by default to measure the sender only.")
+    arg_parser.add_argument('--no-lyrics', action='store_true', help='send no lyrics images')
+    arg_parser.add_argument(
+        '--login', choices=['pkce', 'password'],
+        help='log in to a fake identity provider with this flow. Default is a cached token.')
+    arg_parser.add_argument(
+        '--setting', action='append', default=[], type=parse_setting, metavar='NAME=VALUE',
+        help='extra setting for the sender, e.g. AUDIO_PREFETCH=4(can be repeated)')
+    arg_parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    arg_parser.add_argument('-v', '--verbose', action='store_true', help='show output of the sender')
+    arg_parser.add_argument('--child', help=argparse.SUPPRESS)
+    arg_parser.add_argument('--result', help=argparse.SUPPRESS)
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.child:
+        child_result = run_child(json.loads(args.child))
+        with open(args.result, 'w') as result_file:
+            json.dump(child_result, result_file)
+        sys.exit()
+
+    results = []
+    for scenario_name in args.scenario or list(SCENARIOS):
+        for engine_name in args.engine or ['sync', 'async']:
+            scenario_result = run_scenario(scenario_name, engine_name, args)
+            if args.json:
+                print(json.dumps(scenario_result), flush=True)
+            results.append(scenario_result)
+    if not args.json:
+        print_results(results)
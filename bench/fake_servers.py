@@ -0,0 +1,354 @@
+"""Local stand-ins of the BMM api, its identity provider and the telegram bot api used by benchmark.py"""
+import re
+import json
+import time
+import base64
+import hashlib
+import secrets
+import threading
+from http.cookies import SimpleCookie
+from urllib.parse import urlparse, parse_qs, unquote_plus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeServer:
+    """Threaded http server on a free localhost port. Counts bytes sent and received."""
+
+    def __init__(self, handler_class):
+        server = self
+
+        class Handler(handler_class):
+            fake_server = server
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count(self, bytes_sent=0, bytes_received=0, requests=0):
+        with self._lock:
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+            self.requests += requests
+
+    def reset_counts(self):
+        with self._lock:
+            self.bytes_sent = self.bytes_received = self.requests = 0
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fake_server = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.fake_server.count(bytes_sent=len(body), requests=1)
+
+
+class FakeBmmServer(FakeServer):
+    """BMM api serving tracks of given days in given languages:
+        GET /podcast/<id>/track/?size=&from=  Tracks in language of Accept-Language, newest first
+        GET /file/<day>/<lang>.mp3             Audio of audio_size bytes. Supports Range requests.
+    Every response waits `latency` seconds. Audio is sent at `bandwidth` bytes per second(None is unlimited).
+    """
+
+    def __init__(self, days, audio_size, latency=0.0, bandwidth=None):
+        self.days = sorted(days, reverse=True)
+        self.audio_size = audio_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        super().__init__(BmmHandler)
+
+    def get_tracks(self, lang):
+        return [{
+            'id': index,
+            'title': f'Fra Kåre {day} {lang}',
+            'published_at': f'{day}T05:00:00+01:00',
+            'media': [{'files': [{
+                'url': f'{self.url}/file/{day}/{lang}.mp3',
+                'size': self.audio_size,
+                'duration': 300,
+            }]}],
+            'rel': [{'name': 'herrens_veier', 'id': index % 900 + 1}],
+        } for index, day in enumerate(self.days)]
+
+
+class BmmHandler(QuietHandler):
+
+    def do_GET(self):
+        server = self.fake_server
+        time.sleep(server.latency)
+        url = urlparse(self.path)
+        if re.fullmatch(r'/podcast/\d+/track/', url.path):
+            query = parse_qs(url.query)
+            offset = int(query.get('from', ['0'])[0])
+            size = int(query.get('size', ['1000'])[0])
+            tracks = server.get_tracks(self.headers.get('Accept-Language', 'nb'))
+            self.send_json(tracks[offset:offset + size])
+        elif url.path.startswith('/file/'):
+            self.send_audio()
+        else:
+            self.send_error(404)
+
+    def send_audio(self):
+        server = self.fake_server
+        start = 0
+        range_match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if range_match and int(range_match.group(1)) < server.audio_size:
+            start = int(range_match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{server.audio_size - 1}/{server.audio_size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(server.audio_size - start))
+        self.end_headers()
+
+        chunk = b'\xff' * (64 * 1024)
+        remaining = server.audio_size - start
+        start_time = time.monotonic()
+        sent = 0
+        while remaining > 0:
+            data = chunk[:remaining]
+            self.wfile.write(data)
+            sent += len(data)
+            remaining -= len(data)
+            if server.bandwidth:
+                # Sleep until the bytes sent so far fit the bandwidth
+                delay = sent / server.bandwidth - (time.monotonic() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+        server.count(bytes_sent=sent, requests=1)
+
+
+class FakeTelegramServer(FakeServer):
+    """Telegram bot api answering /bot<token>/<method> like telegram, after `latency` seconds.
+    Uploads are read completely and counted, but only their start(with the form fields) is kept.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.message_id = 0
+        self.file_id = 0
+        self.id_lock = threading.Lock()
+        super().__init__(TelegramHandler)
+
+    def next_ids(self):
+        with self.id_lock:
+            self.message_id += 1
+            self.file_id += 1
+            return self.message_id, f'file-{self.file_id}'
+
+
+class TelegramHandler(QuietHandler):
+
+    keep_size = 64 * 1024
+
+    def read_chunks(self):
+        """Yield chunks of the request body"""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, 64 * 1024))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def read_body(self):
+        """Read the whole body. Return its first keep_size bytes and its size."""
+        body = bytearray()
+        size = 0
+        for chunk in self.read_chunks():
+            size += len(chunk)
+            if len(body) < self.keep_size:
+                body += chunk[:self.keep_size - len(body)]
+        return bytes(body), size
+
+    def do_POST(self):
+        server = self.fake_server
+        body, size = self.read_body()
+        server.count(bytes_received=size)
+        time.sleep(server.latency)
+
+        method = self.path.rsplit('/', 1)[-1]
+        message_id, file_id = server.next_ids()
+        if method == 'sendAudio':
+            result = {'message_id': message_id, 'audio': {'file_id': file_id}}
+        elif method == 'sendPhoto':
+            result = {'message_id': message_id, 'photo': [{'file_id': file_id}]}
+        elif method == 'sendMediaGroup':
+            # One message per photo in the 'media' json field
+            photo_count = unquote_plus(body.decode('latin-1')).count('"type": "photo"')
+            result = [
+                {'message_id': message_id + index, 'photo': [{'file_id': f'{file_id}-{index}'}]}
+                for index in range(photo_count)
+            ]
+        else:
+            result = {'message_id': message_id}
+        self.send_json({'ok': True, 'result': result})
+
+
+class FakeIdpServer(FakeServer):
+    """OIDC identity provider with one user and one client:
+        GET  /authorize     Checks the PKCE request and redirects to the login page(with a session cookie)
+        GET  /login         Login form
+        POST /login         Redirects to redirect_uri with a code if username and password are right.
+                            Shows the login form again else.
+        POST /oauth/token   grant_type 'authorization_code'(checks code_verifier), 'password' and 'refresh_token'
+    """
+
+    def __init__(self, username, password, client_id, redirect_uri, latency=0.0):
+        self.username = username
+        self.password = password
+        self.client_id = client_id
+        self.redirect_uri = redirect_uri
+        self.latency = latency
+        self.logins = {}
+        self.codes = {}
+        self.refresh_tokens = set()
+        super().__init__(IdpHandler)
+
+    def get_tokens(self):
+        refresh_token = secrets.token_urlsafe(16)
+        self.refresh_tokens.add(refresh_token)
+        return {
+            'access_token': secrets.token_urlsafe(32),
+            'refresh_token': refresh_token,
+            'token_type': 'Bearer',
+            'expires_in': 3600,
+        }
+
+
+class IdpHandler(QuietHandler):
+
+    login_form = (
+        '<html><body><form method="post" action="/login">'
+        '<input type="hidden" name="login_id" value="{login_id}">'
+        '<input type="email" name="email"><input type="password" name="password">'
+        '<button type="submit" name="submit" value="login">Sign in</button>'
+        '</form></body></html>'
+    )
+
+    def redirect(self, location, cookie=None):
+        self.send_response(302)
+        self.send_header('Location', location)
+        if cookie:
+            self.send_header('Set-Cookie', cookie)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.fake_server.count(requests=1)
+
+    def send_html(self, html):
+        body = html.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.fake_server.count(bytes_sent=len(body), requests=1)
+
+    def get_login(self):
+        """Login of the session cookie"""
+        cookie = SimpleCookie(self.headers.get('Cookie', ''))
+        login_id = cookie['login'].value if 'login' in cookie else None
+        return login_id, self.fake_server.logins.get(login_id)
+
+    def read_form(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        return {name: values[0] for name, values in parse_qs(body.decode()).items()}
+
+    def do_GET(self):
+        server = self.fake_server
+        time.sleep(server.latency)
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.path == '/authorize':
+            if (query.get('client_id') != server.client_id or query.get('redirect_uri') != server.redirect_uri
+                    or query.get('code_challenge_method') != 'S256' or not query.get('code_challenge')):
+                self.send_error(400)
+                return
+            login_id = secrets.token_urlsafe(8)
+            server.logins[login_id] = query
+            self.redirect('/login', cookie=f'login={login_id}; Path=/; HttpOnly')
+        elif url.path == '/login':
+            login_id, login = self.get_login()
+            if login is None:
+                self.send_error(400)
+                return
+            self.send_html(self.login_form.format(login_id=login_id))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        server = self.fake_server
+        time.sleep(server.latency)
+        form = self.read_form()
+        if self.path == '/login':
+            login_id, login = self.get_login()
+            if login is None or form.get('login_id') != login_id:
+                self.send_error(400)
+                return
+            if form.get('email') != server.username or form.get('password') != server.password:
+                self.send_html(self.login_form.format(login_id=login_id))
+                return
+            code = secrets.token_urlsafe(16)
+            server.codes[code] = server.logins.pop(login_id)
+            self.redirect(f"{server.redirect_uri}?code={code}&state={login['state']}")
+        elif self.path == '/oauth/token':
+            self.send_token(form)
+        else:
+            self.send_error(404)
+
+    def send_token(self, form):
+        server = self.fake_server
+        grant_type = form.get('grant_type')
+        if form.get('client_id') != server.client_id:
+            self.send_json({'error': 'invalid_client'}, status=401)
+            return
+        if grant_type == 'authorization_code':
+            login = server.codes.pop(form.get('code'), None)
+            verifier = form.get('code_verifier', '')
+            challenge = base64.urlsafe_b64encode(hashlib.sha256(verifier.encode()).digest()).rstrip(b'=').decode()
+            if login is None or login['code_challenge'] != challenge or form.get('redirect_uri') != server.redirect_uri:
+                self.send_json({'error': 'invalid_grant', 'error_description': 'Invalid code'}, status=400)
+                return
+        elif grant_type == 'password':
+            if form.get('username') != server.username or form.get('password') != server.password:
+                self.send_json({'error': 'invalid_grant', 'error_description': 'Wrong email or password.'}, status=403)
+                return
+        elif grant_type == 'refresh_token':
+            if form.get('refresh_token') not in server.refresh_tokens:
+                self.send_json({'error': 'invalid_grant'}, status=400)
+                return
+        else:
+            self.send_json({'error': 'unsupported_grant_type'}, status=400)
+            return
+        self.send_json(server.get_tokens())
@@ -5,15 +5,22 @@ From @Stolpervogel(Pascal Ilg) - Telegram
 Modified by Eliezer to change authentication mechanism.
     - Use token based authentication instead of basic authentication.
     - Get access token by logging in using puppeteer.
+    - Cache token data on disk and refresh it before it expires.
+    - Log in with OidcLogin(without a browser). puppeteer is used if that fails.
 """
 import os
 import re
 import sys
+import json
+import time
 import shutil
+import threading
 import subprocess
 
 import requests
 
+from http_session import create_session
+from metrics import metrics
 
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 
@@ -42,9 +49,15 @@ def not_found(response):
     return response.status_code == requests.codes.not_found
 
 
-def assert_ok(response):
+def partial_content(response):
+    return response.status_code == requests.codes.partial_content
+
+
+def assert_ok(response, allow_partial=False):
     if ok(response):
         return True
+    if allow_partial and partial_content(response):
+        return True
     if forbidden(response):
         raise notAuthorized()
     if not_found(response):
@@ -58,48 +71,200 @@ class MinimalBmmApi:
 
     lang_list = ['de', 'en', 'es', 'fi', 'fr', 'hu', 'it', 'nb', 'nl', 'pl', 'pt', 'ro', 'ru', 'sl', 'ta', 'tr']
 
-    def __init__(self, base_url):
+    def __init__(self, base_url, token_store=None, token_url=None, client_id=None, refresh_margin=300,
+                 session=None, timeout=15, response_cache=None, oidc_login=None, browser_login=True):
+        """
+        token_store: TokenStore used to reuse token data between runs
+        token_url: OIDC token endpoint used to refresh the access token
+        client_id: OIDC client id of BMM used to refresh the access token
+        refresh_margin: Seconds before expiry at which the token is refreshed
+        session: requests Session whose connection pool is used for all requests
+        timeout: Timeout in seconds of every request
+        response_cache: ResponseCache used to send conditional requests for json responses
+        oidc_login: OidcLogin used to log in with username and password
+        browser_login: If True, log in with the browser(get_token.js) when there is no oidc_login or it fails
+        """
+        self.session = session or create_session()
+        self.timeout = timeout
+        self.response_cache = response_cache
         self.authenticated = False
         self.token = None
+        self.token_data = None
         self.base_url = base_url
         self.lang = 'nb'
+        self.token_store = token_store
+        self.token_url = token_url
+        self.client_id = client_id
+        self.refresh_margin = refresh_margin
+        self._token_lock = threading.Lock()
+        self._refresh_timer = None
+        self.oidc_login = oidc_login
+        self.browser_login = browser_login
+        self._credentials = None
 
     def _get_token(self):
-        """Call external nodejs script `get_token.js` to get access token"""
-        print('Getting token')
-        res = subprocess.run(
-                    ['node', f'{SCRIPT_DIR}/get_token.js'],
-                    stdout=subprocess.PIPE, stderr=sys.stdout,
-                    text=True
-                )
-        token = res.stdout
-        return token.strip()
-
-    def _get_response(self, method, path, use_auth, **kwargs):
+        """Call external nodejs script `get_token.js` to get token data.
+        Return the token data dict or None on failure.
+        """
+        print('Getting token', flush=True)
+        with metrics.span('bmm_login'):
+            res = subprocess.run(
+                        ['node', f'{SCRIPT_DIR}/get_token.js'],
+                        stdout=subprocess.PIPE, stderr=sys.stdout,
+                        text=True
+                    )
+        try:
+            token_data = json.loads(res.stdout)
+        except ValueError:
+            return None
+        if not isinstance(token_data, dict):
+            return None
+        return token_data
+
+    def _login(self):
+        """Log in with oidc_login. Fall back to the browser login. Return the token data or None."""
+        token_data = None
+        if self.oidc_login and self._credentials:
+            token_data = self.oidc_login.login(*self._credentials)
+        if token_data is None and self.browser_login:
+            token_data = self._get_token()
+        return token_data
+
+    def _refresh_token(self, token_data):
+        """Get new token data using the refresh token in given token data.
+        Return the new token data dict or None if refreshing is not possible.
+        """
+        refresh_token = (token_data or {}).get('refresh_token')
+        if not (refresh_token and self.token_url and self.client_id):
+            return None
+        print('Refreshing token', flush=True)
+        try:
+            with metrics.span('bmm_token_refresh'):
+                response = self.session.post(self.token_url, data={
+                    'grant_type': 'refresh_token',
+                    'client_id': self.client_id,
+                    'refresh_token': refresh_token,
+                }, timeout=self.timeout)
+        except requests.RequestException:
+            return None
+        if not ok(response):
+            return None
+        new_token_data = dict(token_data)
+        try:
+            new_token_data.update(response.json())
+        except ValueError:
+            return None
+        if 'expires_in' in new_token_data:
+            new_token_data['expires_at'] = int(time.time()) + int(new_token_data['expires_in'])
+        return new_token_data
+
+    def _is_token_valid(self, token_data):
+        """Token is valid if it is well formed and does not expire within refresh_margin"""
+        if not token_data:
+            return False
+        token = token_data.get('access_token')
+        if not token or re.search(r'\s', token):
+            return False
+        expires_at = token_data.get('expires_at')
+        if expires_at is None:
+            return False
+        return expires_at - self.refresh_margin > time.time()
+
+    def _set_token_data(self, token_data):
+        """Use given token data, cache it and schedule its refresh"""
+        with self._token_lock:
+            token = (token_data or {}).get('access_token')
+            if not token or re.search(r'\s', token):
+                self.authenticated = False
+                return
+            self.token_data = token_data
+            self.token = token
+            self.authenticated = True
+        if self.token_store:
+            self.token_store.set_token_data(token_data)
+        self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        """Refresh token in a background thread shortly before it expires"""
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+        expires_at = self.token_data.get('expires_at')
+        if expires_at is None:
+            return
+        delay = max(expires_at - self.refresh_margin - time.time(), 0)
+        self._refresh_timer = threading.Timer(delay, self._renew_token)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _renew_token(self):
+        """Refresh token. Log in again if refreshing fails."""
+        token_data = self._refresh_token(self.token_data)
+        if token_data is None:
+            token_data = self._login()
+        self._set_token_data(token_data)
+
+    def _get_response(self, method, path, use_auth, lang=None, extra_headers=None, **kwargs):
+        """Send request in given language. Language set by setLanguage is used if lang is None."""
         url = self.base_url + path
+        if lang is None:
+            lang = self.lang
+        else:
+            self._check_language(lang)
         # 'Accept-Language': 'de-DE,de;q=0.8,en-US;q=0.6,en;q=0.4,nb;q=0.2',
         headers = {
             'Accept': 'application/json',
-            'Accept-Language': '{0}'.format(self.lang),
+            'Accept-Language': '{0}'.format(lang),
             'Accept-Encoding': 'gzip, deflate, sdch, br',
             'Authorization': f'Bearer {self.token}'
         }
+        if extra_headers:
+            headers.update(extra_headers)
 
         if method == 'GET':
-            return requests.get(
-                url, params=kwargs, headers=headers)
+            return self.session.get(
+                url, params=kwargs, headers=headers, timeout=self.timeout)
 
         if method == 'POST':
-            return requests.post(
-                url, data=kwargs, headers=headers)
+            return self.session.post(
+                url, data=kwargs, headers=headers, timeout=self.timeout)
 
         raise ValueError('Unknown request method {0}!'.format(method))
 
-    def _get(self, path, **kwargs):
-        return self._get_response('GET', path, True, **kwargs)
+    def _get(self, path, lang=None, **kwargs):
+        return self._get_response('GET', path, True, lang=lang, **kwargs)
+
+    def _get_json(self, path, lang=None, **kwargs):
+        """GET json response.
+        If a response of the same request is cached, send a conditional request
+        and use the cached data if it is not modified.
+        """
+        if not self.response_cache:
+            response = self._get(path, lang=lang, **kwargs)
+            assert_ok(response)
+            return response.json()
+
+        cache_key = self.response_cache.get_key(path, lang or self.lang, kwargs)
+        cached = self.response_cache.get(cache_key)
+        extra_headers = {}
+        if cached and cached.get('etag'):
+            extra_headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            extra_headers['If-Modified-Since'] = cached['last_modified']
+
+        response = self._get(path, lang=lang, extra_headers=extra_headers, **kwargs)
+        if cached and response.status_code == requests.codes.not_modified:
+            return cached['data']
+        assert_ok(response)
+        data = response.json()
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            self.response_cache.set(cache_key, etag, last_modified, data)
+        return data
 
-    def _post(self, path, **kwargs):
-        return self._get_response('POST', path, True, **kwargs)
+    def _post(self, path, lang=None, **kwargs):
+        return self._get_response('POST', path, True, lang=lang, **kwargs)
 
     def download(self, url, path, use_auth=True):
         response = self.get_response_object(url, use_auth)
@@ -109,43 +274,75 @@ class MinimalBmmApi:
             fobj.decode_content = True
             shutil.copyfileobj(fobj, fout)
 
-    def get_response_object(self, url, use_auth=True):
-        headers = {
+    def get_response_object(self, url, use_auth=True, headers=None):
+        """Return streamed response of url.
+        headers: Extra request headers. '206 Partial Content' is accepted if a 'Range' is requested.
+        """
+        request_headers = {
             'Accept-Encoding': 'gzip, deflate, sdch, br',
         }
+        if headers:
+            request_headers.update(headers)
         query_params = { 'auth': f'Bearer {self.token}' }
-        response = requests.get(url, headers=headers, stream=True, params=query_params, timeout=15)
-        assert_ok(response)
+        response = self.session.get(url, headers=request_headers, stream=True, params=query_params, timeout=self.timeout)
+        assert_ok(response, allow_partial='Range' in request_headers)
         return response
 
     def authenticate(self, username, password):
+        """Authenticate using cached token data if still valid.
+        Else refresh the cached token and only log in(see _login) if that fails.
+        """
         os.environ['BMM_USERNAME'] = username
         os.environ['BMM_PASSWORD'] = password
-        self.token = self._get_token()
-        if not self.token or re.search(r'\s', self.token):
-            self.authenticated = False
+        self._credentials = (username, password)
+        token_data = None
+        if self.token_store:
+            token_data = self.token_store.get_token_data()
+        if self._is_token_valid(token_data):
+            print('Using cached token', flush=True)
         else:
-            self.authenticated = True
+            token_data = self._refresh_token(token_data)
+            if token_data is None:
+                token_data = self._login()
+        self._set_token_data(token_data)
 
     def is_authenticated(self):
         return self.authenticated
 
-    def setLanguage(self, lang):
+    def _check_language(self, lang):
         if lang not in self.lang_list:
             raise ValueError("Not supported language: " + lang)
-        self.lang = lang
-
-    def podcasts(self):
-        response = self._get('/podcast/')
-        assert_ok(response)
-        return response.json()
 
-    def podcast(self, id):
-        response = self._get('/podcast/{0}'.format(id))
-        assert_ok(response)
-        return response.json()
+    def setLanguage(self, lang):
+        """Set default language of requests"""
+        self._check_language(lang)
+        self.lang = lang
 
-    def podcastTracks(self, id):
-        response = self._get('/podcast/{0}/track/'.format(id))
-        assert_ok(response)
-        return response.json()
+    def podcasts(self, lang=None):
+        return self._get_json('/podcast/', lang=lang)
+
+    def podcast(self, id, lang=None):
+        return self._get_json('/podcast/{0}'.format(id), lang=lang)
+
+    def podcastTracks(self, id, lang=None, **params):
+        """Return tracks of podcast, newest first.
+        params: Query parameters like `size` and `from`(offset) to get one page of tracks
+        """
+        with metrics.span('bmm_tracks', lang=lang or self.lang) as span:
+            tracks = self._get_json('/podcast/{0}/track/'.format(id), lang=lang, **params)
+            span['tracks'] = len(tracks)
+        return tracks
+
+    def podcastTracksSince(self, id, day, lang=None, page_size=10):
+        """Return tracks of podcast published on or after day('YYYY-MM-DD'), newest first.
+        Pages through the tracks and stops at the first page which reaches older tracks.
+        """
+        tracks = []
+        offset = 0
+        while True:
+            page = self.podcastTracks(id, lang=lang, **{'size': page_size, 'from': offset})
+            tracks.extend(page)
+            if len(page) < page_size or any(track['published_at'][:10] < day for track in page):
+                break
+            offset += page_size
+        return [track for track in tracks if track['published_at'][:10] >= day]
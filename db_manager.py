@@ -1,35 +1,111 @@
 import os
 import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from metrics import metrics
 
 
 class DatabaseManager():
-    """Simple JSON database to maintain track id of last sent track.
+    """SQLite database to maintain the last sent day and the delivery status of tracks.
+
+    Every update is a single row write in its own transaction, so a crash never leaves
+    the database half written and updates do not get slower as history grows.
 
-    DB fromat:
-    {
-        "last_sent_day": "2019-11-25"
-    }
+    Tables:
+        state(key, value)
+            'last_sent_day': Last day sent to all chats. e.g. '2019-11-25'
+        chat_state(chat_id, last_sent_day)
+            Last day sent to each chat
+        deliveries(day, chat_id, kind, lang, status, updated_at, message_ids)
+            Journal of every message sent to a chat on a day: audio(kind 'audio', one row per language),
+            song header message(kind 'lyrics_header', lang '') and song lyrics(kind 'lyrics', lang '').
+            Status is 'sent' and message_ids are the comma separated telegram message ids.
+            Used to resume a partially sent day at the first message which was not sent.
     """
 
-    def __init__(self, db_file):
-        """Open db file if exists.
-        Else, initialize db
+    def __init__(self, db_file, legacy_json_file=None):
+        """Open db file and create tables if needed.
+        If the db is new and legacy_json_file(old database.json) exists, import its data.
         """
         self.db_filename = db_file
-        self.db_data = None
-
-        if os.path.isfile(self.db_filename):
-            with open(self.db_filename) as db_file:
-                self.db_data = json.load(db_file)
-        else:
-            self.db_data = {}
-
-    def get_last_sent_day(self):
-        """Return 'last_sent_day'"""
-        return self.db_data.get('last_sent_day')
-
-    def set_last_sent_day(self, track_pub_day):
-        """Set 'last_sent_day' and write immediately"""
-        self.db_data['last_sent_day'] = track_pub_day
-        with open(self.db_filename, 'w') as db_file:
-            json.dump(self.db_data, db_file, indent=4)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.db_filename, check_same_thread=False)
+        with self._lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS chat_state (chat_id TEXT PRIMARY KEY, last_sent_day TEXT)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS deliveries ('
+                'day TEXT, chat_id TEXT, kind TEXT, lang TEXT, status TEXT, updated_at TEXT, '
+                'PRIMARY KEY (day, chat_id, kind, lang))')
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(deliveries)')]
+            if 'message_ids' not in columns:
+                self.connection.execute('ALTER TABLE deliveries ADD COLUMN message_ids TEXT')
+
+        if legacy_json_file and os.path.isfile(legacy_json_file) and self._is_empty():
+            self._import_json(legacy_json_file)
+
+    def _is_empty(self):
+        row = self.connection.execute(
+            'SELECT (SELECT COUNT(*) FROM state) + (SELECT COUNT(*) FROM chat_state)').fetchone()
+        return row[0] == 0
+
+    def _import_json(self, json_file_path):
+        """Import data of old JSON database"""
+        with open(json_file_path) as json_file:
+            db_data = json.load(json_file)
+        if 'last_sent_day' in db_data:
+            self.set_last_sent_day(db_data['last_sent_day'])
+        for chat_id, last_sent_day in db_data.get('chats', {}).items():
+            self.set_last_sent_day(last_sent_day, chat_id=chat_id)
+
+    def get_last_sent_day(self, chat_id=None):
+        """Return 'last_sent_day' of given chat.
+        If chat_id is None or the chat has no entry, return 'last_sent_day' of all chats.
+        """
+        with self._lock:
+            if chat_id is not None:
+                row = self.connection.execute(
+                    'SELECT last_sent_day FROM chat_state WHERE chat_id = ?', (str(chat_id),)).fetchone()
+                if row is not None:
+                    return row[0]
+            row = self.connection.execute(
+                "SELECT value FROM state WHERE key = 'last_sent_day'").fetchone()
+        return row[0] if row else None
+
+    def set_last_sent_day(self, track_pub_day, chat_id=None):
+        """Set 'last_sent_day' of given chat(or of all chats if chat_id is None) and write immediately"""
+        with metrics.span('db_write', table='state' if chat_id is None else 'chat_state'), \
+                self._lock, self.connection:
+            if chat_id is None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO state (key, value) VALUES ('last_sent_day', ?)",
+                    (track_pub_day,))
+            else:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO chat_state (chat_id, last_sent_day) VALUES (?, ?)',
+                    (str(chat_id), track_pub_day))
+
+    def is_delivered(self, day, chat_id, kind, lang=''):
+        """Return True if audio(of lang)/lyrics header/lyrics of day was sent to chat"""
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT status FROM deliveries WHERE day = ? AND chat_id = ? AND kind = ? AND lang = ?',
+                (day, str(chat_id), kind, lang)).fetchone()
+        return row is not None and row[0] == 'sent'
+
+    def set_delivered(self, day, chat_id, kind, lang='', message_ids=None):
+        """Record that audio(of lang)/lyrics header/lyrics of day was sent to chat as given telegram messages"""
+        with metrics.span('db_write', table='deliveries'), self._lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO deliveries (day, chat_id, kind, lang, status, updated_at, message_ids) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (day, str(chat_id), kind, lang, 'sent', datetime.now().isoformat(timespec='seconds'),
+                 ','.join(map(str, message_ids or []))))
+
+    def close(self):
+        self.connection.close()
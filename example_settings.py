@@ -3,10 +3,78 @@
 BMM_USERNAME = "my-bmm-username"
 BMM_PASSWORD = "my-bmm-password"
 PODCAST_ID = 54
+# Optional. Used to refresh the cached access token(token.json) without logging in again.
+# If not set, the browser login(get_token.js) is used whenever the cached token expires.
+# Set them to the token endpoint and client id of BMM's identity provider(the values below are only examples).
+# BMM_TOKEN_URL = "https://login.bcc.no/oauth/token"
+# BMM_CLIENT_ID = "bmm-web-client-id"
+# Optional. Log in without a browser: 'pkce'(login form of the identity provider, needs BMM_AUTHORIZE_URL
+# and BMM_REDIRECT_URI), 'password'(resource owner password grant, if the client allows it) or 'browser'.
+# Needs BMM_TOKEN_URL and BMM_CLIENT_ID.
+BMM_LOGIN_FLOW = "pkce"
+# BMM_AUTHORIZE_URL = "https://login.bcc.no/authorize"
+# BMM_REDIRECT_URI = "https://bmm.brunstad.org/callback"
+# BMM_SCOPE = "openid profile offline_access"
+# BMM_AUDIENCE = "https://bmm-api.brunstad.org"
+# Fall back to the browser login(get_token.js, needs nodejs) if logging in without a browser fails
+BMM_BROWSER_LOGIN = True
+# Optional. Number of tracks fetched per request when looking for new tracks
+TRACKS_PAGE_SIZE = 10
 
 # Telegram Settings
 TELEGRAM_BOT_TOKEN = "my-telegram-bot-token"
 TELEGRAM_CHAT_ID = "telegram-chat-id-to-which-to-send"
+# Optional. Send to several chats instead of TELEGRAM_CHAT_ID.
+# Each chat gets the languages in its 'lang'(default LANG). Languages must also be in LANG.
+# TELEGRAM_CHATS = [
+#     {'chat_id': 'telegram-chat-id-1', 'lang': ['en', 'nb']},
+#     {'chat_id': 'telegram-chat-id-2', 'lang': ['en']},
+# ]
+FAN_OUT_WORKERS = 4  # Chats sent to concurrently
+
+# Optional. Base urls of the BMM api and the telegram bot api(e.g. local stand-ins of bench/benchmark.py)
+# BMM_API_URL = "https://bmm-api.brunstad.org"
+# TELEGRAM_API_URL = "https://api.telegram.org"
+# Optional. Only with a local bot api server(TELEGRAM_API_URL = "http://localhost:8081") started with --local
+# on this machine. Files on disk are then sent by their path instead of being uploaded and can be up to 2000 MB.
+TELEGRAM_LOCAL_MODE = False
+
+# Optional. HTTP connection pool and timeouts used for BMM and Telegram requests
+HTTP_POOL_SIZE = 8  # Maximum open connections per host
+HTTP_TIMEOUT = 15  # Seconds
+TELEGRAM_UPLOAD_TIMEOUT = 300  # Seconds
+
+# Optional. Telegram requests are kept within these limits. If telegram still answers
+# '429 Too Many Requests', the request is sent again after the time telegram asks for.
+TELEGRAM_RATE = 30  # Requests per second to all chats
+TELEGRAM_CHAT_RATE = 1  # Requests per second to a chat. Use 0.33 for groups(20 messages per minute)
+TELEGRAM_CHAT_BURST = 1  # Requests sent to a chat at once before TELEGRAM_CHAT_RATE applies
+TELEGRAM_MAX_RETRIES = 5
+
+# Optional. Timing of every step(login, listing tracks, downloads, telegram requests, database writes)
+# METRICS_LOG = "metrics.log"  # Every step is appended as a JSON line
+# METRICS_TEXTFILE = "/var/lib/node_exporter/fra_kaare.prom"  # Prometheus metrics written after every run
+# METRICS_PORT = 9478  # Prometheus metrics served on http://localhost:9478/metrics(not 9100 of node_exporter)
+
+# Optional. Make the requests of the sending pipeline(async_sender.py) with aiohttp on the event loop
+# instead of with requests from worker threads.
+ASYNC_ENGINE = False
+
+# Optional. Number of audio files downloaded ahead while the current one is uploading
+AUDIO_PREFETCH = 2
+# Optional. Downloaded audio is kept on disk so retries do not download again. 0 disables the cache.
+MEDIA_CACHE_SIZE = 500  # MB
+# MEDIA_CACHE_DIR = "/path/to/media_cache"  # Default is ./media_cache
+# Optional. Upload audio while it downloads, through a buffer of AUDIO_RELAY_BUFFER_SIZE MB, instead of
+# downloading it into a file first. Audio is then not prefetched or cached.
+AUDIO_RELAY = False
+AUDIO_RELAY_BUFFER_SIZE = 1  # MB
+
+# Optional. Used when running as daemon(main.py --daemon)
+PUBLISH_TIME = "05:00"  # Local time at which new tracks are usually published on weekdays
+POLL_LEAD_TIME = 300  # Start polling these many seconds before PUBLISH_TIME
+POLL_INTERVAL = 15  # Seconds. Doubled after every failed poll
+MAX_POLL_INTERVAL = 900  # Seconds
 
 # Which all languages should Fra Kåre be sent in
 # Supported values: 'de', 'en', 'es', 'fi', 'fr', 'hu', 'it', 'nb', 'nl', 'pl', 'pt', 'ro', 'ru', 'sl', 'ta', 'tr'
@@ -0,0 +1,55 @@
+import os
+import json
+import threading
+
+from file_utils import dump_json_atomic
+
+
+class FileIdCache():
+    """Simple JSON file to remember telegram file_id of uploaded files.
+
+    Files which were uploaded once are sent again by file_id, without uploading them.
+    Audio is identified by its BMM url and local files by path, modification time and size.
+
+    File format:
+    {
+        "https://bmm-api.brunstad.org/file/.../track.mp3": "CQACAgUAAx...",
+        "/path/to/song_lyrics/HV-en/1.png:1575270000000000000:123456": "AgACAgUAAx...",
+        ...
+    }
+    """
+
+    def __init__(self, cache_file):
+        """Load cache file if it exists"""
+        self.cache_filename = cache_file
+        self.file_ids = {}
+        self._lock = threading.Lock()
+
+        if os.path.isfile(self.cache_filename):
+            try:
+                with open(self.cache_filename) as cache_file:
+                    self.file_ids = json.load(cache_file)
+            except ValueError:
+                self.file_ids = {}
+
+    @staticmethod
+    def file_key(file_path):
+        """Return cache key of a local file. Key changes when the file is modified."""
+        stat = os.stat(file_path)
+        return f'{os.path.abspath(file_path)}:{stat.st_mtime_ns}:{stat.st_size}'
+
+    def get(self, key):
+        """Return file_id of key or None"""
+        return self.file_ids.get(key)
+
+    def set(self, key, file_id):
+        """Set file_id of key and write immediately"""
+        with self._lock:
+            self.file_ids[key] = file_id
+            dump_json_atomic(self.file_ids, self.cache_filename)
+
+    def remove(self, key):
+        """Forget file_id of key. Used when telegram does not accept the file_id anymore."""
+        with self._lock:
+            if self.file_ids.pop(key, None) is not None:
+                dump_json_atomic(self.file_ids, self.cache_filename)
@@ -0,0 +1,47 @@
+import os
+import json
+import hashlib
+import tempfile
+
+
+def get_umask():
+    """Return umask of the process. os.umask can only be read by setting it."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Mode of files created by open(), read once as reading the umask changes it for a moment
+DEFAULT_FILE_MODE = 0o666 & ~get_umask()
+
+
+def write_text_atomic(text, file_path, mode=DEFAULT_FILE_MODE):
+    """Write text to file_path with permissions mode(default as open() would create it).
+    Text is written to a temporary file which then replaces file_path,
+    so file_path never contains partially written data.
+    """
+    file_dir = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=file_dir, prefix='.tmp-')
+    try:
+        # mkstemp creates files readable only by the owner
+        os.chmod(tmp_path, mode)
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(text)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def dump_json_atomic(data, file_path, indent=4, mode=DEFAULT_FILE_MODE):
+    """Write data as json to file_path(see write_text_atomic)"""
+    write_text_atomic(json.dumps(data, indent=indent), file_path, mode=mode)
+
+
+def get_file_sha256(file_path, chunk_size=64 * 1024):
+    """Return hex sha256 of the file at file_path, read in chunks of chunk_size bytes"""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
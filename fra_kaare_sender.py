@@ -4,98 +4,246 @@ import json
 import traceback
 from datetime import datetime, timedelta
 import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
-from requests.exceptions import RequestException
-from requests.packages.urllib3.exceptions import ReadTimeoutError
 
 import settings
 from bmmapi import MinimalBmmApi, BmmApiError
 from db_manager import DatabaseManager
+from file_id_cache import FileIdCache
+from http_session import create_session
+from lyrics_index import LyricsIndex
+from metrics import metrics
+from oidc_login import OidcLogin
+from rate_limiter import RateLimiter
+from media_cache import MediaCache
+from response_cache import ResponseCache
+from token_store import TokenStore
 from telegram_bot import TelegramBot
+from track_catalogue import TrackCatalogue
 
 
 class FraKaareSender:
     """Send new tracks from Fra Kåre podcast to Telegram channel.
 
     Uses MinimalBmmApi to get details of all tracks form Fra Kåre podcast.
+    Listed tracks are kept as compact records in the track catalogue(tracks.sqlite3, see TrackCatalogue).
 
-    Id of the last track successfully sent is maintained in the database(database.json).
+    Day of the last track successfully sent is maintained in the database(database.sqlite3).
     This is used to find out which tracks are new.
+    The database also records each audio/lyrics sent to each chat, to resume a partially sent day.
     DatabaseManager is used to interact with the database.
 
-    TelegramBot uploads audio/images to given chat.
+    TelegramBot uploads audio/images to given chats.
+    Each track is downloaded and uploaded once and sent to other chats by its telegram file_id.
+    If settings.AUDIO_RELAY is True, audio is uploaded while it downloads(AudioRelay) instead of
+    being downloaded ahead into files.
+
+    Tracks are sent by AsyncFraKaareSender on an asyncio event loop(see run_async). It uses MinimalBmmApi
+    and TelegramBot from the executor, or their aiohttp versions if settings.ASYNC_ENGINE is True.
     """
 
     def __init__(self, try_times=3):
         self.try_times = try_times
 
-        self.bmm_api = MinimalBmmApi('https://bmm-api.brunstad.org')
+        pool_size = getattr(settings, 'HTTP_POOL_SIZE', 8)
+        timeout = getattr(settings, 'HTTP_TIMEOUT', 15)
+
+        self.bmm_api = MinimalBmmApi(
+            getattr(settings, 'BMM_API_URL', 'https://bmm-api.brunstad.org'),
+            token_store=TokenStore(os.path.join(settings.SCRIPT_DIR, 'token.json')),
+            token_url=getattr(settings, 'BMM_TOKEN_URL', None),
+            client_id=getattr(settings, 'BMM_CLIENT_ID', None),
+            session=create_session(pool_maxsize=pool_size),
+            timeout=timeout,
+            response_cache=ResponseCache(os.path.join(settings.SCRIPT_DIR, 'bmm_cache.json')),
+            oidc_login=self.get_oidc_login(timeout),
+            browser_login=getattr(settings, 'BMM_BROWSER_LOGIN', True),
+        )
+
+        self.authenticate()
+
+        self.bot = TelegramBot(
+            settings.TELEGRAM_BOT_TOKEN,
+            session=create_session(pool_maxsize=pool_size),
+            timeout=timeout,
+            upload_timeout=getattr(settings, 'TELEGRAM_UPLOAD_TIMEOUT', 300),
+            rate_limiter=RateLimiter(
+                rate=getattr(settings, 'TELEGRAM_RATE', 30),
+                chat_rate=getattr(settings, 'TELEGRAM_CHAT_RATE', 1),
+                chat_burst=getattr(settings, 'TELEGRAM_CHAT_BURST', 1)),
+            max_retries=getattr(settings, 'TELEGRAM_MAX_RETRIES', 5),
+            api_url=getattr(settings, 'TELEGRAM_API_URL', 'https://api.telegram.org'),
+            local_mode=getattr(settings, 'TELEGRAM_LOCAL_MODE', False),
+        )
+
+        self.db_man = DatabaseManager(
+            os.path.join(settings.SCRIPT_DIR, 'database.sqlite3'),
+            legacy_json_file=os.path.join(settings.SCRIPT_DIR, 'database.json'))
+
+        self.file_id_cache = FileIdCache(os.path.join(
+            settings.SCRIPT_DIR, 'file_ids.json'))
+
+        self.track_catalogue = TrackCatalogue(os.path.join(settings.SCRIPT_DIR, 'tracks.sqlite3'))
+
+        self.lyrics_index = LyricsIndex(os.path.join(
+            settings.SCRIPT_DIR, 'song_lyrics', 'catalogue.json'))
+
+        self.media_cache = None
+        media_cache_size = getattr(settings, 'MEDIA_CACHE_SIZE', 500)
+        if media_cache_size:
+            self.media_cache = MediaCache(
+                self.bmm_api,
+                getattr(settings, 'MEDIA_CACHE_DIR', os.path.join(settings.SCRIPT_DIR, 'media_cache')),
+                max_size=media_cache_size * 1024 * 1024)
+
+        self.chats = self.get_chats()
+        self.fan_out_workers = getattr(settings, 'FAN_OUT_WORKERS', 4)
+        self.audio_relay = getattr(settings, 'AUDIO_RELAY', False)
+        self.audio_relay_buffer_size = getattr(settings, 'AUDIO_RELAY_BUFFER_SIZE', 1) * 1024 * 1024
+
+    @staticmethod
+    def get_chats():
+        """Return chats to send to and their languages from settings.
+        [
+            {'chat_id': 'chat-id-1', 'lang': ['en', 'nb']},
+            {'chat_id': 'chat-id-2', 'lang': ['en']},
+        ]
+        """
+        chats = getattr(settings, 'TELEGRAM_CHATS', None)
+        if not chats:
+            return [{'chat_id': settings.TELEGRAM_CHAT_ID, 'lang': list(settings.LANG)}]
+        return [
+            {'chat_id': chat['chat_id'], 'lang': list(chat.get('lang', settings.LANG))}
+            for chat in chats
+        ]
 
+    @staticmethod
+    def get_oidc_login(timeout=15):
+        """Return OidcLogin of the login flow in settings(BMM_LOGIN_FLOW).
+        None if the flow is 'browser' or its settings are missing. The browser login is used then.
+        """
+        flow = getattr(settings, 'BMM_LOGIN_FLOW', 'pkce')
+        token_url = getattr(settings, 'BMM_TOKEN_URL', None)
+        client_id = getattr(settings, 'BMM_CLIENT_ID', None)
+        authorize_url = getattr(settings, 'BMM_AUTHORIZE_URL', None)
+        redirect_uri = getattr(settings, 'BMM_REDIRECT_URI', None)
+        if flow == 'browser' or not (token_url and client_id):
+            return None
+        if flow == 'pkce' and not (authorize_url and redirect_uri):
+            return None
+        return OidcLogin(
+            token_url,
+            client_id,
+            flow=flow,
+            authorize_url=authorize_url,
+            redirect_uri=redirect_uri,
+            scope=getattr(settings, 'BMM_SCOPE', 'openid profile offline_access'),
+            audience=getattr(settings, 'BMM_AUDIENCE', None),
+            timeout=timeout,
+        )
+
+    def authenticate(self, try_times=None):
+        """Authenticate with BMM. Try again after 180 seconds on failure."""
+        if try_times is None:
+            try_times = self.try_times
         print('Authenticating user')
-        for try_ind in range(self.try_times):
-            self.bmm_api.authenticate(
-                settings.BMM_USERNAME, settings.BMM_PASSWORD)
+        for try_ind in range(try_times):
+            with metrics.span('authenticate'):
+                self.bmm_api.authenticate(
+                    settings.BMM_USERNAME, settings.BMM_PASSWORD)
             if self.bmm_api.is_authenticated():
                 break
-            time.sleep(180)
             print(f"Authentication failed. try {try_ind+1}...", flush=True)
+            if try_ind + 1 < try_times:
+                time.sleep(180)
 
-        self.bot = TelegramBot(settings.TELEGRAM_BOT_TOKEN)
+    def run_async(self, send):
+        """Run coroutine send(async_sender) to completion with asyncio.run and return its result.
+        async_sender is the AsyncFraKaareSender of this sender(see AsyncFraKaareSender.open).
+        Blocking calls of the pipeline(requests, database, files) share the default executor.
+        """
+        from async_sender import AsyncFraKaareSender
 
-        self.db_man = DatabaseManager(os.path.join(
-            settings.SCRIPT_DIR, 'database.json'))
+        async def run():
+            workers = self.fan_out_workers + getattr(settings, 'AUDIO_PREFETCH', 2) + len(settings.LANG) + 4
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers))
+            async with AsyncFraKaareSender.open(self) as async_sender:
+                return await send(async_sender)
+        return asyncio.run(run())
 
     def _send_new_tracks(self):
         """Look at the last sent day and send all the pending tracks"""
-        last_sent_day = self.db_man.get_last_sent_day()
-        print(f'Last sent day: {last_sent_day}', flush=True)
-        new_tracks = self.get_new_tracks()
-        if not new_tracks:
-            print("No tracks to send", flush=True)
-            return
-        days_to_send = sorted(new_tracks.keys())
-        print(f"Days to send: {', '.join(days_to_send)}", flush=True)
-        for day in days_to_send:
-            print(f"Sending track of: {day}", end='', flush=True)
-            send_success = self.send_tracks(new_tracks[day])
-            if send_success:
-                print(' - Success', flush=True)
-                self.db_man.set_last_sent_day(day)
-            else:
-                print(' - Fail', flush=True)
-                break
+        self.run_async(lambda async_sender: async_sender.send_new_tracks())
 
-    def _are_tracks_pending(self):
-        """If the latest track was not sent, return True"""
-        last_sent_day_str = self.db_man.get_last_sent_day()
-        now = datetime.now()
-        today_date_str = now.strftime('%Y-%m-%d')
+    def get_audio_urls_to_download(self, new_tracks, chats=None):
+        """Return audio urls of new_tracks in the order in which they are sent.
+        Audio which was uploaded before is sent by file_id and needs no download.
+        Audio which was sent to all its chats is left out too.
+        chats: Chats(see get_chats) to send to. Default is all chats.
+        """
+        if chats is None:
+            chats = self.chats
+        audio_urls = [
+            new_tracks[day][lang]['url']
+            for day in sorted(new_tracks)
+            for lang in settings.LANG
+            if new_tracks[day].get(lang) and any(
+                lang in chat['lang'] and not self.db_man.is_delivered(day, chat['chat_id'], 'audio', lang)
+                for chat in chats
+            )
+        ]
+        return [url for url in audio_urls if not self.file_id_cache.get(url)]
+
+    def get_day_chats(self, day, chats):
+        """Return chats which did not get day yet(it was sent before some other chat failed)"""
+        return [
+            chat for chat in chats
+            if (self.db_man.get_last_sent_day(chat['chat_id']) or '') < day
+        ]
+
+    @staticmethod
+    def get_last_weekday(now):
+        """Return the last Mon-Fri on or before now"""
         today_day = int(now.strftime('%w'))  # 6 - Sat, 0 - Sun
-        last_weekday_str = today_date_str
-        # Get last weekday
         if today_day in (6, 0):
             days_since_last_friday = (today_day + 1) % 7 + 1
-            last_weekday = now - timedelta(days_since_last_friday)
-            last_weekday_str = last_weekday.strftime('%Y-%m-%d')
+            return now - timedelta(days_since_last_friday)
+        return now
+
+    def _are_tracks_pending(self):
+        """If the latest track was not sent, return True"""
+        last_sent_day_str = self.db_man.get_last_sent_day()
+        last_weekday_str = self.get_last_weekday(datetime.now()).strftime('%Y-%m-%d')
         # today_day not in ('Sat', 'Sun') and
         if last_weekday_str != last_sent_day_str:
             return True
         else:
             return False
 
+    def try_send_new_tracks(self):
+        """Send new tracks once. Errors are logged and not raised."""
+        engine = 'async' if getattr(settings, 'ASYNC_ENGINE', False) else 'sync'
+        try:
+            with metrics.span('send_new_tracks', engine=engine):
+                self._send_new_tracks()
+        except BmmApiError:
+            print(f'Got api error.', flush=True)
+            traceback.print_exc()
+            sys.stdout.flush()
+        except Exception:
+            print(f'Got unknown error.', flush=True)
+            traceback.print_exc()
+            sys.stdout.flush()
+        metrics.set('tracks_pending', int(self._are_tracks_pending()))
+        metrics.set('last_run_timestamp_seconds', int(time.time()))
+        metrics.write_textfile()
+
     def send_new_tracks(self):
         for i in range(self.try_times):
             print(f'Trying to get todays track: try {i+1}', flush=True)
-            try:
-                self._send_new_tracks()
-            except BmmApiError:
-                print(f'Got api error.', flush=True)
-                traceback.print_exc()
-                sys.stdout.flush()
-            except Exception:
-                print(f'Got unknown error.', flush=True)
-                traceback.print_exc()
-                sys.stdout.flush()
+            self.try_send_new_tracks()
             if self._are_tracks_pending():
                 print('Pending tracks exist.', flush=True)
             else:
@@ -103,100 +251,43 @@ class FraKaareSender:
             print(f'Sleeping for 180 seconds...')
             time.sleep(180)
 
-    def get_new_tracks(self):
-        """Return new tracks which have not yet been sent.
-        [
-            '2019-25-11': {
-                'en': track,
-                'nb': track
-            },
-            ...
-        ]
+    def catalogue_tracks(self, tracks_by_lang, last_sent_day):
+        """Add tracks of each language(as listed by AsyncFraKaareSender.get_new_tracks for last_sent_day) to the track catalogue.
+        Return their records by language.
+        """
+        # All tracks since last_sent_day were listed. Listings without a last sent day are only
+        # one page(the latest tracks), so they are not recorded as synced.
+        return {
+            lang: self.track_catalogue.add_tracks(lang, tracks, since=last_sent_day or None)
+            for lang, tracks in tracks_by_lang.items()
+        }
+
+    def group_new_tracks(self, tracks_by_lang, last_sent_day):
+        """Return records(of each language in tracks_by_lang) newer than last_sent_day by day.
+        See AsyncFraKaareSender.get_new_tracks.
         """
         new_tracks = {}
         for lang in settings.LANG:
             new_tracks_lang = []
-            self.bmm_api.setLanguage(lang)
-            fra_kaare_tracks = self.bmm_api.podcastTracks(settings.PODCAST_ID)
-            last_sent_day = self.db_man.get_last_sent_day()
+            fra_kaare_tracks = tracks_by_lang[lang]
 
             if last_sent_day is None:
                 new_tracks_lang.append(fra_kaare_tracks[0])
             elif last_sent_day == '':
                 new_tracks_lang = fra_kaare_tracks
             else:
-                for index, track in enumerate(fra_kaare_tracks):
-                    if track['published_at'].startswith(last_sent_day):
-                        break
-                new_tracks_lang.extend(fra_kaare_tracks[:index])
+                new_tracks_lang = [
+                    track for track in fra_kaare_tracks
+                    if track['day'] > last_sent_day
+                ]
 
             for track in new_tracks_lang:
-                track_day = self.get_day_from_ts(track['published_at'])
-                if track_day not in new_tracks:
-                    new_tracks[track_day] = {}
-                new_tracks[track_day][lang] = track
+                if track['day'] not in new_tracks:
+                    new_tracks[track['day']] = {}
+                new_tracks[track['day']][lang] = track
 
         return new_tracks
 
-    def get_day_from_ts(self, timestamp):
-        """ 2019-01-01T04:00:51+01:00 -> 2019-01-01 """
-        return timestamp[:10]
-
-    def get_track_info(self, track):
-        """Get basic information about the track
-        Return:
-            {
-                'title': 'Track title',
-                'url': 'audio_url',
-                'song_book': '[HV|MB]',
-                'song_number': number
-            }
-        """
-        # Initial values
-        song_info = {
-            'title': None,
-            'url': None,
-            'song_book': None,
-            'song_number': None,
-        }
-
-        # Get title
-        song_info['title'] = track.get('title')
-
-        # Get audio url
-        song_url = files = None
-        media = track.get('media')
-        if media:
-            files = media[0].get('files')
-        if files:
-            song_url = files[0].get('url')
-        song_info['url'] = song_url
-
-        # Get song info
-        song_book_long_to_short = {
-            'herrens_veier': 'HV',
-            'mandelblomsten': 'MB',
-        }
-
-        rel_song = {}
-        if 'rel' in track and track['rel']:
-            rel_song = track['rel'][0]
-
-        song_book = rel_song.get('name')
-        song_number = rel_song.get('id')
-        if not (song_book and song_number):
-            return song_info
-
-        if song_book in song_book_long_to_short:
-            song_book = song_book_long_to_short[song_book]
-        else:
-            song_book = song_book.replace('_', ' ').title()
-
-        song_info['song_book'] = song_book
-        song_info['song_number'] = song_number
-
-        return song_info
-
     def get_track_caption(self, track_info, add_song_info=True):
         """Get caption for the track
         Return:
@@ -216,80 +307,9 @@ class FraKaareSender:
 
         return '\n'.join(caption_lines)
 
-    def send_tracks(self, tracks):
-        """Download and send Fra Kåre tracks of a specific day to telegram channel.
+    def send_tracks(self, tracks, chats=None):
+        """Send Fra Kåre tracks of a specific day to telegram chats. See AsyncFraKaareSender.send_tracks
         Return:
-            False on error
-            True otherwise
+            List of chat_ids to which the tracks could not be sent
         """
-        song_book = None
-        song_number = None
-        song_lyrics_files = []
-        for lang in settings.LANG:
-            self.bmm_api.setLanguage(lang)
-            if not tracks.get(lang):
-                continue
-            track_info = self.get_track_info(tracks[lang])
-            track_url = track_info['url']
-            track_title = track_info['title']
-            # Remove space as telegram adds random thumbnails and album arts otherwise
-            track_title_no_space = track_title.replace(' ', '_')
-
-            # There is no url. Silently skip sending this track.
-            if not track_url or not track_title:
-                return False
-
-            audio_caption = self.get_track_caption(
-                track_info, add_song_info=False)
-
-            try:
-                # Send audio file
-                response = self.bmm_api.get_response_object(track_url)
-                raw_response_stream = response.raw
-                self.bot.send_audio(
-                    raw_response_stream,
-                    chat_id=settings.TELEGRAM_CHAT_ID,
-                    caption=audio_caption,
-                    title=track_title_no_space,
-                    parse_mode='HTML'
-                )
-            except (RequestException, ReadTimeoutError):
-                traceback.print_exc()
-                sys.stdout.flush()
-                return False
-
-            # Set song info
-            if not song_book:
-                song_book = track_info['song_book']
-                song_number = track_info['song_number']
-
-            song_lyric_file_path = os.path.join(
-                settings.SCRIPT_DIR, 'song_lyrics', f"{song_book}-{lang}", f'{song_number}.png')
-            # If lyric file is not found for song, continue
-            if not os.path.isfile(song_lyric_file_path):
-                continue
-            song_lyrics_files.append(open(song_lyric_file_path, 'rb'))
-
-        # If there is no song information for track, return
-        if not song_lyrics_files:
-            return True
-        elif song_lyrics_files:
-            self.bot.send_message(
-                text=f'<b>Song:</b> {song_book} {song_number}',
-                chat_id=settings.TELEGRAM_CHAT_ID,
-                parse_mode='HTML'
-            )
-
-        # Send song lyrics
-        if len(song_lyrics_files) > 1:
-            self.bot.send_media_group(
-                song_lyrics_files,
-                chat_id=settings.TELEGRAM_CHAT_ID
-            )
-        elif song_lyrics_files:
-            self.bot.send_photo(
-                song_lyrics_files[0],
-                chat_id=settings.TELEGRAM_CHAT_ID
-            )
-
-        return True
+        return self.run_async(lambda async_sender: async_sender.send_tracks(tracks, chats=chats))
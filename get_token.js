@@ -22,9 +22,8 @@ const puppeteer = require('puppeteer');
             console.error('Waiting for token to be set.');
             token_data_str = await page.evaluate("localStorage.getItem('oidc')");
             if (token_data_str || elapsedTime >= timeout) {
-                token_data = JSON.parse(token_data_str)
-                // Print actual access_token to STDOUT
-                console.log(token_data.access_token)
+                // Print whole token data(access_token, expires_at, refresh_token...) to STDOUT
+                console.log(token_data_str)
                 clearInterval(intervalId);
                 await browser.close();
             }
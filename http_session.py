@@ -0,0 +1,21 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def create_session(pool_connections=4, pool_maxsize=8, pool_block=True):
+    """Return a requests Session with a keep-alive connection pool.
+
+    pool_connections: Number of hosts for which connections are pooled
+    pool_maxsize: Maximum number of open connections per host
+    pool_block: If True, wait for a free connection instead of opening
+                more than pool_maxsize connections to a host
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
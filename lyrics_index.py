@@ -0,0 +1,234 @@
+import os
+import re
+import sys
+import json
+import argparse
+import threading
+
+from file_utils import dump_json_atomic, get_file_sha256
+
+
+class LyricsIndex():
+    """In memory index of song lyrics images, loaded from the catalogue written by
+    song_lyrics/epub_to_images.py(song_lyrics/catalogue.json).
+
+    Lyrics are looked up without touching the file system. reload loads the catalogue again
+    if it was changed(e.g. lyrics were rendered again while the sender runs).
+    The telegram file_id of an uploaded image is kept in the catalogue, next to the image it belongs to.
+
+    Catalogue format:
+    {
+        "HV": {
+            "en": {
+                "1": {"file": "HV-en/1.png", "size": 123456, "sha256": "...", "file_id": "AgACAgUAAx..."},
+                ...
+            }
+        }
+    }
+    File paths are relative to the catalogue.
+
+    Installs which only have image directories next to the catalogue(song_lyrics/<book>-<lang>/<number>.png)
+    get a catalogue built from them on the first start(see build_catalogue).
+    """
+
+    def __init__(self, catalogue_file):
+        """Load catalogue file if it exists"""
+        self.catalogue_filename = catalogue_file
+        self.catalogue = {}
+        self.books = {}
+        self._mtime_ns = None
+        self._lock = threading.Lock()
+
+        if os.path.isfile(self.catalogue_filename):
+            self.reload()
+        else:
+            self._set_catalogue(self.build_catalogue())
+
+    def _get_mtime_ns(self):
+        """Return modification time of the catalogue file or None if it does not exist"""
+        try:
+            return os.stat(self.catalogue_filename).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _read_catalogue(self):
+        """Return catalogue in the catalogue file or None if it does not exist or is not valid"""
+        try:
+            with open(self.catalogue_filename) as catalogue_file:
+                return json.load(catalogue_file)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            print(f"Lyrics catalogue '{self.catalogue_filename}' is not valid JSON. It is not used.")
+            return None
+
+    def _set_catalogue(self, catalogue):
+        self.catalogue = catalogue
+        # Book names are matched case insensitively, e.g. 'HV' and 'Hv'
+        self.books = {book.upper(): book for book in catalogue}
+
+    def reload(self):
+        """Load the catalogue file again if it changed since it was loaded or written"""
+        mtime_ns = self._get_mtime_ns()
+        if mtime_ns is None or mtime_ns == self._mtime_ns:
+            return
+        with self._lock:
+            self._mtime_ns = mtime_ns
+            catalogue = self._read_catalogue()
+            if catalogue is not None:
+                self._set_catalogue(catalogue)
+
+    def build_catalogue(self):
+        """Return catalogue of the images in the directories next to the catalogue file,
+        named like song_lyrics/HV-en/1.png. Write it to the catalogue file if any are found.
+        """
+        lyrics_dir = os.path.dirname(os.path.abspath(self.catalogue_filename))
+        catalogue = {}
+        image_count = 0
+        dir_names = os.listdir(lyrics_dir) if os.path.isdir(lyrics_dir) else []
+        for dir_name in sorted(dir_names):
+            dir_match = re.fullmatch(r'(.+)-([a-z]{2,3})', dir_name)
+            if not dir_match or not os.path.isdir(os.path.join(lyrics_dir, dir_name)):
+                continue
+            book, lang = dir_match.group(1).upper(), dir_match.group(2)
+            for file_name in sorted(os.listdir(os.path.join(lyrics_dir, dir_name))):
+                file_match = re.fullmatch(r'(\d+)\.(png|jpg|webp)', file_name)
+                if not file_match:
+                    continue
+                file_path = os.path.join(lyrics_dir, dir_name, file_name)
+                catalogue.setdefault(book, {}).setdefault(lang, {})[str(int(file_match.group(1)))] = {
+                    'file': os.path.join(dir_name, file_name),
+                    'size': os.path.getsize(file_path),
+                    'sha256': get_file_sha256(file_path),
+                }
+                image_count += 1
+
+        if not catalogue:
+            print(f"Lyrics catalogue '{self.catalogue_filename}' not found. No lyrics are sent. "
+                  f"Run song_lyrics/epub_to_images.py to create it.")
+            return catalogue
+        dump_json_atomic(catalogue, self.catalogue_filename)
+        self._mtime_ns = self._get_mtime_ns()
+        print(f"Lyrics catalogue '{self.catalogue_filename}' created from {image_count} images in {lyrics_dir}")
+        return catalogue
+
+    def get(self, song_book, lang, song_number):
+        """Return lyrics image of song or None if it is not in the catalogue:
+            {
+                'song_book': 'HV',
+                'lang': 'en',
+                'song_number': '1',
+                'path': '/path/to/song_lyrics/HV-en/1.png',
+                'size': 123456,
+                'sha256': '...',
+                'file_id': 'AgACAgUAAx...' or None,
+            }
+        """
+        if not song_book or song_number is None:
+            return None
+        book = self.books.get(str(song_book).upper())
+        if book is None:
+            return None
+        song = self.catalogue[book].get(lang, {}).get(str(song_number))
+        if song is None:
+            return None
+        return {
+            'song_book': book,
+            'lang': lang,
+            'song_number': str(song_number),
+            'path': os.path.join(os.path.dirname(os.path.abspath(self.catalogue_filename)), song['file']),
+            'size': song.get('size'),
+            'sha256': song.get('sha256'),
+            'file_id': song.get('file_id'),
+        }
+
+    def set_file_id(self, lyrics, file_id):
+        """Set telegram file_id of lyrics(as returned by get) and write immediately.
+        Use None to forget a file_id telegram does not accept anymore.
+        The catalogue file is read again and only the file_id is changed, so changes made by
+        epub_to_images.py meanwhile are kept. The file_id is not set if the image was changed.
+        """
+        with self._lock:
+            catalogue = self._read_catalogue()
+            if catalogue is None:
+                catalogue = self.catalogue
+            song = catalogue.get(lyrics['song_book'], {}).get(lyrics['lang'], {}).get(lyrics['song_number'])
+            if song is not None and song.get('sha256') == lyrics['sha256'] and song.get('file_id') != file_id:
+                if file_id:
+                    song['file_id'] = file_id
+                else:
+                    song.pop('file_id', None)
+                dump_json_atomic(catalogue, self.catalogue_filename)
+            self._mtime_ns = self._get_mtime_ns()
+            self._set_catalogue(catalogue)
+
+    def get_missing_songs(self):
+        """Return song numbers missing in each language of each book.
+        A song is missing when some other language of the book has it.
+            {
+                'HV': {'en': [], 'nb': ['12', '40']},
+            }
+        """
+        missing_songs = {}
+        for book, langs in self.catalogue.items():
+            all_song_numbers = set()
+            for songs in langs.values():
+                all_song_numbers.update(songs)
+            missing_songs[book] = {
+                lang: sorted(all_song_numbers - set(songs), key=int)
+                for lang, songs in langs.items()
+            }
+        return missing_songs
+
+    def get_invalid_songs(self, check_hash=False):
+        """Return lyrics whose image is missing or does not match its size(and sha256 if check_hash)"""
+        invalid_songs = []
+        for book, langs in self.catalogue.items():
+            for lang, songs in langs.items():
+                for song_number in sorted(songs, key=int):
+                    lyrics = self.get(book, lang, song_number)
+                    if not os.path.isfile(lyrics['path']):
+                        invalid_songs.append((lyrics, 'file not found'))
+                    elif os.path.getsize(lyrics['path']) != lyrics['size']:
+                        invalid_songs.append((lyrics, 'size changed'))
+                    elif check_hash and get_file_sha256(lyrics['path']) != lyrics['sha256']:
+                        invalid_songs.append((lyrics, 'sha256 changed'))
+        return invalid_songs
+
+
+def get_args():
+    """Parse and return command line arguments"""
+    arg_parser = argparse.ArgumentParser(description='Check the song lyrics catalogue used by the sender')
+    arg_parser.add_argument(
+        '-c', '--catalogue',
+        default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'song_lyrics', 'catalogue.json'),
+        help="path to the catalogue. Default is 'song_lyrics/catalogue.json'"
+    )
+    arg_parser.add_argument(
+        '--hash',
+        action='store_true',
+        help='also check the sha256 of every image'
+    )
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if not os.path.isfile(args.catalogue):
+        print(f"Catalogue '{args.catalogue}' not found. Run song_lyrics/epub_to_images.py to create it.")
+        sys.exit(1)
+    lyrics_index = LyricsIndex(args.catalogue)
+
+    problems = 0
+    for book, langs in sorted(lyrics_index.get_missing_songs().items()):
+        for lang, song_numbers in sorted(langs.items()):
+            song_count = len(lyrics_index.catalogue[book][lang])
+            print(f"{book}-{lang}: {song_count} songs, {len(song_numbers)} missing"
+                  + (f": {', '.join(song_numbers)}" if song_numbers else ''))
+            problems += len(song_numbers)
+
+    for lyrics, reason in lyrics_index.get_invalid_songs(check_hash=args.hash):
+        print(f"{lyrics['song_book']}-{lyrics['lang']} {lyrics['song_number']}: {lyrics['path']} {reason}")
+        problems += 1
+
+    sys.exit(1 if problems else 0)
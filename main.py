@@ -3,6 +3,8 @@ import argparse
 
 import settings
 from fra_kaare_sender import FraKaareSender
+from metrics import metrics
+from scheduler import SenderScheduler
 
 
 def validate_settings():
@@ -10,7 +12,6 @@ def validate_settings():
         'BMM_USERNAME',
         'BMM_PASSWORD',
         'TELEGRAM_BOT_TOKEN',
-        'TELEGRAM_CHAT_ID',
         'LANG',
     ]
 
@@ -20,11 +21,45 @@ def validate_settings():
         if key not in settings.__dict__:
             required_not_found.append(key)
 
+    if 'TELEGRAM_CHAT_ID' not in settings.__dict__ and 'TELEGRAM_CHATS' not in settings.__dict__:
+        required_not_found.append('TELEGRAM_CHAT_ID')
+
     if required_not_found:
         raise Exception(f"Required settings {', '.join(required_not_found)} not found.")
 
 
+def get_args():
+    """Parse and return command line arguments"""
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        '-d', '--daemon',
+        action='store_true',
+        help='keep running and send new tracks as soon as they are published'
+    )
+    return arg_parser.parse_args()
+
+
 if __name__ == '__main__':
+    args = get_args()
     settings.SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+    metrics.configure(
+        log_file=getattr(settings, 'METRICS_LOG', None),
+        textfile=getattr(settings, 'METRICS_TEXTFILE', None),
+    )
+    if getattr(settings, 'METRICS_PORT', None):
+        metrics.start_http_server(settings.METRICS_PORT)
     sender = FraKaareSender(try_times=6)
-    sender.send_new_tracks()
+    if args.daemon:
+        scheduler = SenderScheduler(
+            sender,
+            publish_time=getattr(settings, 'PUBLISH_TIME', '05:00'),
+            lead_time=getattr(settings, 'POLL_LEAD_TIME', 300),
+            poll_interval=getattr(settings, 'POLL_INTERVAL', 15),
+            max_poll_interval=getattr(settings, 'MAX_POLL_INTERVAL', 900),
+        )
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        sender.send_new_tracks()
@@ -0,0 +1,228 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import hashlib
+import threading
+
+from requests.exceptions import RequestException
+
+from bmmapi import BmmApiError
+from file_utils import dump_json_atomic, get_file_sha256
+from metrics import metrics
+
+
+class MediaCacheError(RequestException):
+    """Download did not complete. Handled like other network errors."""
+    pass
+
+
+class MediaCache:
+    """Cache of downloaded BMM audio files on disk.
+
+    Files are stored in cache_dir by sha256 of their url:
+        <key>.part  Partially downloaded file. Download is resumed from its end with a Range request.
+        <key>       Completely downloaded file
+        <key>.json  Url, size, modification time and sha256 of the downloaded file.
+                    Its own modification time is the last time the file was used.
+
+    Size and modification time are checked before a file is used. The sha256 is only checked by verify(),
+    as it was taken from the same download and only finds later corruption on disk.
+
+    Least recently used files are removed when the cache(including partial downloads) grows bigger
+    than max_size bytes. Partial downloads which were not resumed for part_max_age seconds are removed.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, bmm_api, cache_dir, max_size=500 * 1024 * 1024, part_max_age=24 * 3600):
+        self.bmm_api = bmm_api
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.part_max_age = part_max_age
+        self._lock = threading.Lock()
+        self._url_locks = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _get_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest())
+
+    def _get_url_lock(self, url):
+        with self._lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    @staticmethod
+    def _get_meta(path):
+        """Return meta data of completely downloaded file. None if there is none."""
+        try:
+            with open(path + '.json') as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, path, url, sha256=None):
+        stat = os.stat(path)
+        dump_json_atomic({
+            'url': url,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': sha256 or get_file_sha256(path),
+        }, path + '.json')
+
+    def _is_valid(self, path, url):
+        """Return True if completely downloaded file was not changed since it was downloaded"""
+        meta = self._get_meta(path)
+        if meta is None or not os.path.isfile(path):
+            return False
+        stat = os.stat(path)
+        if stat.st_size != meta.get('size'):
+            return False
+        if 'mtime_ns' not in meta:
+            # Written by an older version. Checked once by checksum.
+            if get_file_sha256(path) != meta.get('sha256'):
+                return False
+            self._write_meta(path, url, sha256=meta['sha256'])
+            return True
+        return stat.st_mtime_ns == meta['mtime_ns']
+
+    def verify(self):
+        """Check every completely downloaded file against its checksum and remove corrupt ones.
+        Return urls of the removed files.
+        """
+        removed_urls = []
+        for file_name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file_name)
+            if '.' in file_name or not os.path.isfile(path):
+                continue
+            meta = self._get_meta(path)
+            if meta is None:
+                continue
+            with self._get_url_lock(meta['url']):
+                if get_file_sha256(path) != meta.get('sha256') or os.path.getsize(path) != meta.get('size'):
+                    self._remove(path)
+                    removed_urls.append(meta['url'])
+        return removed_urls
+
+    def _download(self, url, path):
+        """Download url into path. Resume a partial download if there is one."""
+        part_path = path + '.part'
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        # Byte offsets are only meaningful for the unencoded file
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+
+        try:
+            response = self.bmm_api.get_response_object(url, headers=headers)
+        except BmmApiError:
+            if not offset:
+                raise
+            # Partial file can not be resumed(e.g. file changed). Download from start.
+            os.remove(part_path)
+            return self._download(url, path)
+        try:
+            content_range = response.headers.get('Content-Range', '')
+            range_match = re.match(r'bytes (\d+)-\d+/(\d+)', content_range)
+            if offset and response.status_code == 206 and range_match and int(range_match.group(1)) == offset:
+                total_size = int(range_match.group(2))
+                mode = 'ab'
+            else:
+                # Server sent the whole file
+                content_length = response.headers.get('Content-Length')
+                total_size = int(content_length) if content_length else None
+                mode = 'wb'
+            with metrics.span('audio_download', cache='media_cache') as span, open(part_path, mode) as part_file:
+                for chunk in response.iter_content(self.chunk_size):
+                    part_file.write(chunk)
+                span['bytes'] = part_file.tell() - (offset if mode == 'ab' else 0)
+                span['url'] = url
+            metrics.add('audio_download_bytes', span['bytes'])
+        finally:
+            response.close()
+
+        size = os.path.getsize(part_path)
+        if total_size is not None and size != total_size:
+            if size > total_size:
+                # Partial file does not belong to this file. Download from start next time.
+                os.remove(part_path)
+            raise MediaCacheError(f'Downloaded {size} bytes of {total_size} bytes from {url}')
+
+        os.replace(part_path, path)
+        self._write_meta(path, url)
+
+    def get_file_path(self, url):
+        """Return path of the downloaded file of url. Download it if it is not in the cache."""
+        path = self._get_path(url)
+        with self._get_url_lock(url):
+            if self._is_valid(path, url):
+                metrics.add('media_cache_hits')
+            else:
+                metrics.add('media_cache_misses')
+                self._download(url, path)
+            # Mark as recently used. The file itself keeps its modification time.
+            os.utime(path + '.json')
+        self._evict(keep=path)
+        return path
+
+    def open(self, url):
+        """Return downloaded file of url opened for reading"""
+        return open(self.get_file_path(url), 'rb')
+
+    @staticmethod
+    def _remove(path):
+        """Remove file at path and its meta data"""
+        for file_path in (path, path + '.json'):
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+
+    def _evict(self, keep=None):
+        """Remove stale partial downloads. Then remove least recently used files until the cache fits in max_size."""
+        with self._lock:
+            now = time.time()
+            files = []
+            total_size = 0
+            for file_name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, file_name)
+                if not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                if file_name.endswith('.part'):
+                    if now - stat.st_mtime > self.part_max_age:
+                        os.remove(path)
+                    else:
+                        # Partial downloads may be written to right now. They are only counted.
+                        total_size += stat.st_size
+                elif '.' not in file_name:
+                    meta_path = path + '.json'
+                    last_used = os.path.getmtime(meta_path) if os.path.isfile(meta_path) else stat.st_mtime
+                    files.append((last_used, stat.st_size, path))
+                    total_size += stat.st_size
+            for _, size, path in sorted(files):
+                if total_size <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                self._remove(path)
+                total_size -= size
+
+
+def get_args():
+    """Parse and return command line arguments"""
+    arg_parser = argparse.ArgumentParser(description='Verify the checksums of the downloaded audio files')
+    arg_parser.add_argument(
+        'cache_dir', nargs='?',
+        default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'media_cache'),
+        help="cache directory(MEDIA_CACHE_DIR). Default is 'media_cache'")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if not os.path.isdir(args.cache_dir):
+        sys.exit(f"Cache directory '{args.cache_dir}' not found")
+    corrupt_urls = MediaCache(None, args.cache_dir).verify()
+    for corrupt_url in corrupt_urls:
+        print(f'Removed corrupt file of {corrupt_url}')
+    sys.exit(1 if corrupt_urls else 0)
@@ -0,0 +1,171 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from file_utils import write_text_atomic
+
+
+class Metrics:
+    """Timing spans and counters of the sender, exported as JSON logs and in the Prometheus text format.
+
+    Usage:
+        with metrics.span('bmm_tracks', lang='en') as span:
+            ...
+            span['tracks'] = len(tracks)  # Extra field of the JSON log
+        metrics.add('audio_download_bytes', len(chunk))
+
+    Every span is written as a JSON line to log_file(if configured):
+        {"time": "2019-11-25T05:00:01", "span": "bmm_tracks", "lang": "en", "status": "ok", "seconds": 0.412, "tracks": 10}
+    and summed up per span and labels for Prometheus:
+        fra_kaare_span_seconds_sum{span="bmm_tracks",lang="en",status="ok"} 1.236
+        fra_kaare_span_seconds_count{span="bmm_tracks",lang="en",status="ok"} 3
+        fra_kaare_span_last_seconds{span="bmm_tracks",lang="en",status="ok"} 0.412
+        fra_kaare_audio_download_bytes_total 12345678
+    Labels should have few values(language, telegram method...). Chat ids etc. belong in the extra fields.
+    A 'bytes' field also adds the throughput('bytes_per_second') to the JSON log.
+    """
+
+    prefix = 'fra_kaare_'
+
+    def __init__(self):
+        self.log_file = None
+        self.textfile = None
+        self.spans = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def configure(self, log_file=None, textfile=None):
+        """
+        log_file: File to which every span is appended as a JSON line
+        textfile: File to which write_textfile writes all metrics(e.g. for the node_exporter textfile collector)
+        """
+        self.log_file = log_file
+        self.textfile = textfile
+
+    @staticmethod
+    def _get_key(name, labels):
+        # json.dumps formats booleans as 'true'/'false'
+        return (name, tuple(sorted(
+            (key, json.dumps(value) if isinstance(value, bool) else str(value)) for key, value in labels.items())))
+
+    @contextmanager
+    def span(self, name, **labels):
+        """Time the enclosed block. Yields a dict of extra fields for the JSON log."""
+        fields = {}
+        status = 'ok'
+        start_time = time.monotonic()
+        try:
+            yield fields
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            self.record(name, time.monotonic() - start_time, status, labels, fields)
+
+    def record(self, name, seconds, status='ok', labels=None, fields=None):
+        """Record a span which took given seconds"""
+        labels = dict(labels or {}, status=status)
+        fields = dict(fields or {})
+        if fields.get('bytes') and seconds > 0:
+            fields['bytes_per_second'] = round(fields['bytes'] / seconds)
+        key = self._get_key(name, labels)
+        with self._lock:
+            count, total, _ = self.spans.get(key, (0, 0.0, 0.0))
+            self.spans[key] = (count + 1, total + seconds, seconds)
+        if self.log_file:
+            entry = {'time': datetime.now().isoformat(timespec='seconds'), 'span': name}
+            entry.update(labels)
+            entry['seconds'] = round(seconds, 3)
+            entry.update(fields)
+            with self._lock, open(self.log_file, 'a') as log_file:
+                log_file.write(json.dumps(entry, default=str) + '\n')
+
+    def add(self, name, value=1, **labels):
+        """Add value to counter name"""
+        key = self._get_key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set gauge name to value"""
+        with self._lock:
+            self.gauges[self._get_key(name, labels)] = value
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        label_strs = [
+            '{0}="{1}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in labels
+        ]
+        return '{' + ','.join(label_strs) + '}'
+
+    def get_text(self):
+        """Return all metrics in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            spans = sorted(self.spans.items())
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+
+        if spans:
+            lines.append(f'# TYPE {self.prefix}span_seconds summary')
+            for (name, labels), (count, total, _) in spans:
+                label_str = self._format_labels((('span', name),) + labels)
+                lines.append(f'{self.prefix}span_seconds_sum{label_str} {total:.6f}')
+                lines.append(f'{self.prefix}span_seconds_count{label_str} {count}')
+            lines.append(f'# TYPE {self.prefix}span_last_seconds gauge')
+            for (name, labels), (_, _, last) in spans:
+                label_str = self._format_labels((('span', name),) + labels)
+                lines.append(f'{self.prefix}span_last_seconds{label_str} {last:.6f}')
+
+        for names, metric_type, suffix in ((counters, 'counter', '_total'), (gauges, 'gauge', '')):
+            typed_names = set()
+            for (name, labels), value in names:
+                metric_name = f'{self.prefix}{name}{suffix}'
+                if metric_name not in typed_names:
+                    typed_names.add(metric_name)
+                    lines.append(f'# TYPE {metric_name} {metric_type}')
+                lines.append(f'{metric_name}{self._format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self):
+        """Write all metrics to textfile(if configured). The file is replaced at once, never half written."""
+        if not self.textfile:
+            return
+        write_text_atomic(self.get_text(), self.textfile)
+
+    def start_http_server(self, port, host='127.0.0.1'):
+        """Serve metrics on http://host:port/metrics in a background thread. Return the server.
+        Only local clients can connect by default. Use host '' for all interfaces.
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.get_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+
+# Metrics of this process. Configured in main.py.
+metrics = Metrics()
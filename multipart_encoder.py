@@ -0,0 +1,105 @@
+import os
+import uuid
+
+
+class MultipartEncoder:
+    """multipart/form-data body which is read from its files while it is sent.
+
+    requests builds the whole multipart body in memory before sending it.
+    This encoder is a file-like object instead, which requests streams in small blocks:
+        body = MultipartEncoder({'chat_id': 1}, {'audio': audio_file})
+        session.post(url, data=body, headers={'Content-Type': body.content_type})
+    If the size of every file is known(seekable files), the body is sent with a Content-Length.
+    Else it is sent with 'Transfer-Encoding: chunked'.
+    Files are read from their current position.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, fields, files):
+        """
+        fields: Form fields by name. Fields with value None are left out(like requests does).
+        files: File objects opened in binary mode by field name
+        """
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        self._parts = []
+        self.len = 0
+        for name, value in fields.items():
+            if value is None:
+                continue
+            if not isinstance(value, bytes):
+                value = str(value).encode('utf-8')
+            self._add_bytes(self._get_header(name) + value + b'\r\n')
+        for name, file in files.items():
+            self._add_bytes(self._get_header(name, self._get_filename(name, file)))
+            self._add_file(file)
+            self._add_bytes(b'\r\n')
+        self._add_bytes(f'--{self.boundary}--\r\n'.encode())
+
+    def _get_header(self, name, filename=None):
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        return f'--{self.boundary}\r\nContent-Disposition: {disposition}\r\n\r\n'.encode('utf-8')
+
+    @staticmethod
+    def _get_filename(name, file):
+        """Base name of the file's path(like requests). Field name if the file has no path."""
+        file_name = getattr(file, 'name', None)
+        if isinstance(file_name, str) and not (file_name.startswith('<') and file_name.endswith('>')):
+            return os.path.basename(file_name).replace('"', '%22')
+        return name
+
+    def _add_bytes(self, data):
+        self._parts.append(data)
+        if self.len is not None:
+            self.len += len(data)
+
+    def _add_file(self, file):
+        self._parts.append(file)
+        try:
+            position = file.tell()
+            if hasattr(file, 'len'):
+                # Streams which can not seek may know their size(e.g. AudioRelay)
+                size = file.len - position if file.len is not None else None
+            else:
+                size = file.seek(0, os.SEEK_END) - position
+                file.seek(position)
+        except (AttributeError, OSError, ValueError):
+            size = None
+        if size is None:
+            # Size is known only after reading the file
+            self.len = None
+        elif self.len is not None:
+            self.len += size
+
+    def read(self, size=-1):
+        """Return next size bytes of the body(all remaining bytes if size is negative). b'' at the end."""
+        chunks = []
+        remaining = size if size is not None and size >= 0 else None
+        while self._parts and (remaining is None or remaining > 0):
+            part = self._parts[0]
+            if isinstance(part, bytes):
+                data = part if remaining is None else part[:remaining]
+                if len(data) == len(part):
+                    self._parts.pop(0)
+                else:
+                    self._parts[0] = part[len(data):]
+            else:
+                data = part.read(self.chunk_size if remaining is None else min(remaining, self.chunk_size))
+                if not data:
+                    self._parts.pop(0)
+                    continue
+            chunks.append(data)
+            if remaining is not None:
+                remaining -= len(data)
+        return b''.join(chunks)
+
+    def __iter__(self):
+        """Body in chunks of chunk_size bytes. Used by requests for chunked transfer."""
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
@@ -0,0 +1,239 @@
+import os
+import time
+import base64
+import hashlib
+import secrets
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse, parse_qs
+
+import requests
+
+from http_session import create_session
+from metrics import metrics
+
+
+class OidcLoginError(Exception):
+    pass
+
+
+class LoginFormParser(HTMLParser):
+    """Collect the forms of a html page:
+        [{'action': '/login', 'method': 'post', 'inputs': [{'name': 'email', 'type': 'email', 'value': ''}, ...]}]
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+        self._form = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form':
+            self._form = {
+                'action': attrs.get('action') or '',
+                'method': (attrs.get('method') or 'get').lower(),
+                'inputs': [],
+            }
+            self.forms.append(self._form)
+        elif tag in ('input', 'button') and self._form is not None and attrs.get('name'):
+            self._form['inputs'].append({
+                'name': attrs['name'],
+                'type': (attrs.get('type') or ('submit' if tag == 'button' else 'text')).lower(),
+                'value': attrs.get('value') or '',
+            })
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self._form = None
+
+
+class OidcLogin:
+    """Log in to the identity provider of BMM with username and password, without a browser.
+
+    Flows:
+        'pkce': Authorization code flow with PKCE. The login form of the identity provider is
+                filled in and submitted like a browser would, redirects are followed until the
+                redirect_uri and the code is exchanged for tokens. Forms without a password field
+                (e.g. an auto-submitted form after the login) are submitted as they are.
+        'password': Resource owner password grant. One request, if the client is allowed to use it.
+
+    The token data has the format of the `oidc` entry which BMM keeps in localStorage
+    (access_token, refresh_token, expires_at...), so it is used and refreshed like that one.
+    """
+
+    max_steps = 10
+
+    def __init__(self, token_url, client_id, flow='pkce', authorize_url=None, redirect_uri=None,
+                 scope='openid profile offline_access', audience=None, timeout=15):
+        """
+        token_url: Token endpoint of the identity provider
+        client_id: OIDC client id of BMM
+        flow: 'pkce' or 'password'
+        authorize_url: Authorization endpoint of the identity provider. Needed for 'pkce'.
+        redirect_uri: Redirect uri registered for client_id. Needed for 'pkce'. It is never requested.
+        scope: Requested scopes. 'offline_access' asks for a refresh token.
+        audience: Audience of the access token(e.g. url of the BMM api) if the identity provider needs one
+        timeout: Timeout in seconds of every request
+        """
+        if flow not in ('pkce', 'password'):
+            raise ValueError(f'Unknown login flow: {flow}')
+        if flow == 'pkce' and not (authorize_url and redirect_uri):
+            raise ValueError("Login flow 'pkce' needs authorize_url and redirect_uri")
+        self.token_url = token_url
+        self.client_id = client_id
+        self.flow = flow
+        self.authorize_url = authorize_url
+        self.redirect_uri = redirect_uri
+        self.scope = scope
+        self.audience = audience
+        self.timeout = timeout
+
+    def login(self, username, password):
+        """Return token data or None if logging in failed"""
+        print(f'Logging in({self.flow})', flush=True)
+        try:
+            with metrics.span('bmm_login', flow=self.flow):
+                if self.flow == 'pkce':
+                    return self._login_pkce(username, password)
+                return self._login_password(username, password)
+        except (requests.RequestException, OidcLoginError, ValueError) as exc:
+            print(f'Login failed: {exc}', flush=True)
+            return None
+
+    def _get_token_data(self, session, **data):
+        """Request tokens from the token endpoint. Return token data with 'expires_at'."""
+        data['client_id'] = self.client_id
+        response = session.post(self.token_url, data=data, timeout=self.timeout)
+        try:
+            response_json = response.json()
+        except ValueError:
+            response_json = {}
+        if not response.ok:
+            raise OidcLoginError('{0} {1}'.format(
+                response.status_code,
+                response_json.get('error_description') or response_json.get('error') or response.reason))
+        token_data = dict(response_json)
+        if 'expires_in' in token_data:
+            token_data['expires_at'] = int(time.time()) + int(token_data['expires_in'])
+        return token_data
+
+    def _login_password(self, username, password):
+        data = {
+            'grant_type': 'password',
+            'username': username,
+            'password': password,
+            'scope': self.scope,
+        }
+        if self.audience:
+            data['audience'] = self.audience
+        with create_session() as session:
+            return self._get_token_data(session, **data)
+
+    @staticmethod
+    def _get_code_challenge(code_verifier):
+        digest = hashlib.sha256(code_verifier.encode()).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+    def _login_pkce(self, username, password):
+        code_verifier = base64.urlsafe_b64encode(os.urandom(32)).rstrip(b'=').decode()
+        state = secrets.token_urlsafe(16)
+        params = {
+            'response_type': 'code',
+            'client_id': self.client_id,
+            'redirect_uri': self.redirect_uri,
+            'scope': self.scope,
+            'state': state,
+            'nonce': secrets.token_urlsafe(16),
+            'code_challenge': self._get_code_challenge(code_verifier),
+            'code_challenge_method': 'S256',
+        }
+        if self.audience:
+            params['audience'] = self.audience
+
+        # Own session for the cookies of the login
+        with create_session() as session:
+            response = session.get(self.authorize_url, params=params, allow_redirects=False, timeout=self.timeout)
+            credentials_sent = False
+            for _ in range(self.max_steps):
+                if response.is_redirect:
+                    location = urljoin(response.url, response.headers['Location'])
+                    if location.startswith(self.redirect_uri):
+                        code = self._get_code(location, state)
+                        return self._get_token_data(
+                            session,
+                            grant_type='authorization_code',
+                            code=code,
+                            redirect_uri=self.redirect_uri,
+                            code_verifier=code_verifier)
+                    response = session.get(location, allow_redirects=False, timeout=self.timeout)
+                    continue
+
+                response.raise_for_status()
+                form, fields = self._fill_form(response.text, username, password)
+                if form is None:
+                    raise OidcLoginError(f'No login form found at {response.url}')
+                if form['has_password']:
+                    # Login form is shown again if the credentials were not accepted
+                    if credentials_sent:
+                        raise OidcLoginError('Wrong username or password')
+                    if fields is None:
+                        raise OidcLoginError(f'Login form at {response.url} has no username field')
+                    credentials_sent = True
+                action = urljoin(response.url, form['action'])
+                if form['method'] == 'post':
+                    response = session.post(action, data=fields, allow_redirects=False, timeout=self.timeout)
+                else:
+                    response = session.get(action, params=fields, allow_redirects=False, timeout=self.timeout)
+        raise OidcLoginError(f'Not redirected to {self.redirect_uri} after {self.max_steps} steps')
+
+    def _get_code(self, location, state):
+        """Return authorization code of the redirect to redirect_uri"""
+        url = urlparse(location)
+        query = parse_qs(url.query or url.fragment)
+        if 'error' in query:
+            raise OidcLoginError(query.get('error_description', query['error'])[0])
+        if query.get('state') != [state]:
+            raise OidcLoginError('State of the redirect does not match')
+        if 'code' not in query:
+            raise OidcLoginError('No code in the redirect')
+        return query['code'][0]
+
+    @staticmethod
+    def _fill_form(html, username, password):
+        """Return (form, fields) of the form to submit next.
+        Login form(with a password field) gets username and password. Other forms are submitted as they are.
+        form is None if there is no form. fields is None if the username field is not found.
+        """
+        parser = LoginFormParser()
+        parser.feed(html)
+        if not parser.forms:
+            return None, None
+        forms = [form for form in parser.forms if any(field['type'] == 'password' for field in form['inputs'])]
+        form = (forms or parser.forms)[0]
+        form['has_password'] = bool(forms)
+
+        fields = {}
+        submit_added = False
+        for field in form['inputs']:
+            if field['type'] == 'submit':
+                # Only the button which is clicked is sent
+                if not submit_added:
+                    fields[field['name']] = field['value']
+                    submit_added = True
+            elif field['type'] not in ('checkbox', 'radio', 'button', 'image', 'reset'):
+                fields[field['name']] = field['value']
+        if not form['has_password']:
+            return form, fields
+
+        text_fields = [
+            field['name'] for field in form['inputs'] if field['type'] in ('email', 'text')
+        ]
+        preferred = [name for name in text_fields if name.lower() in ('email', 'username', 'login', 'user')]
+        username_fields = preferred or text_fields
+        if not username_fields:
+            return form, None
+        fields[username_fields[0]] = username
+        for field in form['inputs']:
+            if field['type'] == 'password':
+                fields[field['name']] = password
+        return form, fields
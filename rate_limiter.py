@@ -0,0 +1,76 @@
+import time
+import threading
+
+
+class TokenBucket:
+    """Token bucket allowing `rate` requests per second with bursts of up to `capacity` requests.
+
+    A request takes a token right away and waits until the token is due, so requests
+    waiting on the same bucket are served in the order in which they arrived.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Take a token and return seconds to wait before using it"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def pause(self, seconds):
+        """Give out no tokens for the next given seconds"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class RateLimiter:
+    """Limit telegram requests overall and per chat.
+
+    Telegram allows about 30 messages per second overall and 1 message per second in a chat
+    (20 messages per minute in groups). Requests over these limits get '429 Too Many Requests'.
+    """
+
+    def __init__(self, rate=30, chat_rate=1, chat_burst=1):
+        """
+        rate: Requests per second to all chats together
+        chat_rate: Requests per second to a chat
+        chat_burst: Requests sent to a chat at once before chat_rate applies
+        """
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.bucket = TokenBucket(rate, capacity=max(int(rate), 1))
+        self.chat_buckets = {}
+        self._lock = threading.Lock()
+
+    def _get_chat_bucket(self, chat_id):
+        with self._lock:
+            if chat_id not in self.chat_buckets:
+                self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=self.chat_burst)
+            return self.chat_buckets[chat_id]
+
+    def reserve(self, chat_id=None):
+        """Take a turn to send a request to chat_id and return seconds to wait for it"""
+        wait_time = self.bucket.reserve()
+        if chat_id is not None:
+            wait_time = max(wait_time, self._get_chat_bucket(str(chat_id)).reserve())
+        return wait_time
+
+    def pause(self, chat_id, seconds):
+        """Send nothing to chat_id(or to any chat if chat_id is None) for the next given seconds"""
+        if chat_id is None:
+            self.bucket.pause(seconds)
+        else:
+            self._get_chat_bucket(str(chat_id)).pause(seconds)
@@ -0,0 +1,53 @@
+import os
+import json
+import threading
+
+from file_utils import dump_json_atomic
+
+
+class ResponseCache():
+    """Simple JSON file to cache BMM api responses for conditional requests.
+
+    File format:
+    {
+        "<lang> <path>?<query>": {
+            "etag": "\"abc\"",
+            "last_modified": "Mon, 25 Nov 2019 04:00:51 GMT",
+            "data": <response json>
+        },
+        ...
+    }
+    """
+
+    def __init__(self, cache_file):
+        """Load cache file if it exists"""
+        self.cache_filename = cache_file
+        self.cache_data = {}
+        self._lock = threading.Lock()
+
+        if os.path.isfile(self.cache_filename):
+            try:
+                with open(self.cache_filename) as cache_file:
+                    self.cache_data = json.load(cache_file)
+            except ValueError:
+                self.cache_data = {}
+
+    @staticmethod
+    def get_key(path, lang, params):
+        """Return cache key of a request"""
+        query = '&'.join(f'{key}={params[key]}' for key in sorted(params))
+        return f'{lang} {path}?{query}'
+
+    def get(self, key):
+        """Return cached entry of key or None"""
+        return self.cache_data.get(key)
+
+    def set(self, key, etag, last_modified, data):
+        """Cache response data with its validators and write immediately"""
+        with self._lock:
+            self.cache_data[key] = {
+                'etag': etag,
+                'last_modified': last_modified,
+                'data': data,
+            }
+            dump_json_atomic(self.cache_data, self.cache_filename, indent=None)
@@ -0,0 +1,91 @@
+import random
+import threading
+from datetime import datetime, timedelta
+
+
+class SenderScheduler:
+    """Keep a FraKaareSender running and poll BMM around the time new tracks are published.
+
+    Fra Kåre is published Mon-Fri at about `publish_time`(local time).
+    - While tracks are pending and the publish time has passed, BMM is polled with an
+      exponential backoff(with jitter) starting at `poll_interval` seconds.
+    - Otherwise the scheduler sleeps until `lead_time` seconds before the next publish time.
+
+    The sender(and so its authenticated BMM client and connection pools) is reused for all polls.
+    """
+
+    def __init__(self, sender, publish_time='05:00', lead_time=300, poll_interval=15, max_poll_interval=900):
+        """
+        sender: FraKaareSender
+        publish_time: 'HH:MM' local time at which new tracks are usually published
+        lead_time: Seconds before publish_time at which polling starts
+        poll_interval: Seconds to wait after the first failed poll
+        max_poll_interval: Maximum seconds to wait between polls, before a jitter of ±50%
+        """
+        self.sender = sender
+        hour, minute = publish_time.split(':')
+        self.publish_hour = int(hour)
+        self.publish_minute = int(minute)
+        self.lead_time = lead_time
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._stop_event = threading.Event()
+
+    def get_publish_time(self, day):
+        """Return publish datetime on given day"""
+        return day.replace(hour=self.publish_hour, minute=self.publish_minute, second=0, microsecond=0)
+
+    def get_next_publish_time(self, now):
+        """Return the first Mon-Fri publish time after now"""
+        day = now
+        while True:
+            publish_time = self.get_publish_time(day)
+            if publish_time > now and int(day.strftime('%w')) not in (6, 0):
+                return publish_time
+            day += timedelta(days=1)
+
+    def get_backoff(self, attempt):
+        """Return seconds to wait before poll number attempt+1. Jitter avoids polling in lockstep."""
+        # Jitter is applied after the cap, so clients which reached the cap are still spread out
+        interval = min(self.poll_interval * 2 ** (attempt - 1), self.max_poll_interval)
+        return interval * random.uniform(0.5, 1.5)
+
+    def get_poll_start(self, now):
+        """Return time from which BMM should be polled"""
+        if not self.sender._are_tracks_pending():
+            publish_time = self.get_next_publish_time(now)
+            return publish_time - timedelta(seconds=self.lead_time)
+
+        last_weekday = self.sender.get_last_weekday(now)
+        previous_weekday = self.sender.get_last_weekday(last_weekday - timedelta(days=1))
+        if self.sender.db_man.get_last_sent_day() == previous_weekday.strftime('%Y-%m-%d'):
+            # Only the track of last weekday is pending. Poll from its publish time.
+            publish_time = self.get_publish_time(last_weekday)
+            return publish_time - timedelta(seconds=self.lead_time)
+        # Older tracks are pending. Poll now.
+        return now
+
+    def run(self):
+        """Poll until stop() is called"""
+        attempt = 0
+        while not self._stop_event.is_set():
+            if not self.sender.bmm_api.is_authenticated():
+                self.sender.authenticate(try_times=1)
+            if self.sender.bmm_api.is_authenticated():
+                self.sender.try_send_new_tracks()
+
+            now = datetime.now()
+            poll_start = self.get_poll_start(now)
+            if now < poll_start:
+                attempt = 0
+                wait_time = (poll_start - now).total_seconds()
+            else:
+                attempt += 1
+                wait_time = self.get_backoff(attempt)
+            next_poll = now + timedelta(seconds=wait_time)
+            print(f"Next poll at {next_poll.strftime('%Y-%m-%d %H:%M:%S')}", flush=True)
+            self._stop_event.wait(wait_time)
+
+    def stop(self):
+        """Stop run() after the current poll"""
+        self._stop_event.set()
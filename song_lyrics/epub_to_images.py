@@ -1,16 +1,29 @@
 from zipfile import ZipFile
 import argparse
 import tempfile
+import hashlib
 import shutil
+import json
 import os
+import re
 import asyncio
 import math
+import mimetypes
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
 
 from bs4 import BeautifulSoup
 import pyppeteer
+import pyppeteer.errors
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
+MANIFEST_FILE_NAME = 'manifest.json'
+CATALOGUE_FILE_NAME = 'catalogue.json'
+
 
 def get_args():
     """Parse and return command line arguments"""
@@ -21,6 +34,17 @@ def get_args():
         else:
             return file_path
 
+    def song_numbers(value):
+        """'1-3,7' -> {1, 2, 3, 7}"""
+        numbers = set()
+        try:
+            for part in value.split(','):
+                start, _, end = part.partition('-')
+                numbers.update(range(int(start), int(end or start) + 1))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"'{value}' is not a list of song numbers like '1-10,15'")
+        return numbers
+
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument(
         '-b', '--book',
@@ -38,22 +62,92 @@ def get_args():
         '-o', '--output_dir',
         help="path to output directory where images should be stored. Default output dir is './HV' or './MB' based on --book argument"
     )
+    arg_parser.add_argument(
+        '-l', '--lang',
+        help="language of the epub, e.g. 'en'. Default is taken from an output dir named like 'HV-en'"
+    )
+    arg_parser.add_argument(
+        '--catalogue',
+        default=os.path.join(SCRIPT_DIR, CATALOGUE_FILE_NAME),
+        help=f"path to the lyrics catalogue read by the sender. Default is '{CATALOGUE_FILE_NAME}' next to this script"
+    )
+    arg_parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=4,
+        help='number of browser pages taking screenshots in parallel. Default is 4'
+    )
+    arg_parser.add_argument(
+        '--browsers',
+        type=int,
+        default=1,
+        help='number of browser processes to spread the pages over. Default is 1'
+    )
+    arg_parser.add_argument(
+        '-s', '--songs',
+        type=song_numbers,
+        help="song numbers to render, e.g. '1-10,15'. Default is all songs"
+    )
+    arg_parser.add_argument(
+        '--extract',
+        action='store_true',
+        help='extract the epub to a temporary directory instead of serving its files straight from the epub'
+    )
+    arg_parser.add_argument(
+        '--format',
+        choices=list(IMAGE_FORMATS),
+        default='png',
+        help="format of saved images. 'png8' is a palette png. Default is 'png'(screenshot as is)"
+    )
+    arg_parser.add_argument(
+        '--colors',
+        type=int,
+        default=32,
+        help='number of colors(2-256) of png8 images. Default is 32, enough for anti-aliased text'
+    )
+    arg_parser.add_argument(
+        '--quality',
+        type=int,
+        default=85,
+        help='quality(1-100) of jpeg and webp images. Default is 85'
+    )
+    arg_parser.add_argument(
+        '--max-width',
+        type=int,
+        default=TELEGRAM_MAX_WIDTH,
+        help=f'maximum width of optimized images in pixels. Default is {TELEGRAM_MAX_WIDTH}, the width telegram displays'
+    )
+    arg_parser.add_argument(
+        '--force',
+        action='store_true',
+        help='render all songs, even those which did not change since the last run'
+    )
+    arg_parser.add_argument(
+        '--retries',
+        type=int,
+        default=2,
+        help='number of times a song is retried on pyppeteer network/timeout errors. Default is 2'
+    )
 
     args = arg_parser.parse_args()
     if not args.output_dir:
         args.output_dir = os.path.join(SCRIPT_DIR, args.book.upper())
+    if not args.lang:
+        # e.g. 'song_lyrics/HV-en' -> 'en'
+        match = re.fullmatch(rf'{args.book.upper()}-(\w+)', os.path.basename(os.path.normpath(args.output_dir)))
+        args.lang = match.group(1) if match else None
 
     return args
 
 
-def get_songnumber_file_pairs(songnumber_index_file_path):
-    """Read songnumber index file and return list of item in the format:
+def get_songnumber_file_pairs(songnumber_index_html):
+    """Read html of songnumber index file and return list of item in the format:
         [
             (1, 'song_1.html'),
             (2, 'song_2.html')
         ]
     """
-    index_file_soup = BeautifulSoup(open(songnumber_index_file_path), 'html.parser')
+    index_file_soup = BeautifulSoup(songnumber_index_html, 'html.parser')
     anchors = index_file_soup.find_all('a', class_='index-songnumbers2')
 
     songnumber_file_pairs = []
@@ -66,43 +160,399 @@ def get_songnumber_file_pairs(songnumber_index_file_path):
     return songnumber_file_pairs
 
 
-async def get_images(book_type, songnumber_file_pairs, output_dir):
-    """Use pyppeteer to take screenshots of html files and save them in output_dir"""
+class EpubServer:
+    """Serve files of an epub on localhost, reading them from the epub(zip) when requested.
+
+    Usage:
+        server = EpubServer(zip_file)
+        base_url = server.start()  # e.g. 'http://127.0.0.1:45678/'
+        ...
+        server.stop()
+    """
+
+    def __init__(self, zip_file):
+        self.zip_file = zip_file
+        self.file_names = set(zip_file.namelist())
+        self._lock = threading.Lock()
+        self.http_server = None
+
+    def read(self, file_name):
+        """Return content of file in epub or None if it does not exist"""
+        if file_name not in self.file_names:
+            return None
+        with self._lock:
+            return self.zip_file.read(file_name)
+
+    def start(self):
+        """Start serving in a background thread and return base url"""
+        epub_server = self
+
+        class EpubRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                file_name = unquote(urlparse(self.path).path).lstrip('/')
+                content = epub_server.read(file_name)
+                if content is None:
+                    self.send_error(404)
+                    return
+                content_type = mimetypes.guess_type(file_name)[0]
+                if file_name.endswith('.xhtml'):
+                    content_type = 'application/xhtml+xml'
+                self.send_response(200)
+                self.send_header('Content-Type', content_type or 'application/octet-stream')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer(('127.0.0.1', 0), EpubRequestHandler)
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.http_server.server_port}/'
+
+    def stop(self):
+        if self.http_server:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+
+
+VIEWPORT_WIDTH = 411
+VIEWPORT_HEIGHT = math.ceil((VIEWPORT_WIDTH / 9) * 16)  # 16:9 ratio
+DEVICE_SCALE_FACTOR = 4
+# Change RENDER_VERSION when rendering changes, so that all images are rendered again
+RENDER_VERSION = 1
+
+
+def get_song_hashes(book_type, songnumber_file_pairs, read_file, css_file_paths, output_settings=None):
+    """Return hash of each song which changes when its image would change:
+        {
+            1: 'sha256 of song html, all css files and render settings',
+            ...
+        }
+    read_file: Function returning content(bytes) of a file path of the epub
+    output_settings: Dict of output image settings(format, quality...) which also change the image
+    """
+    common_hash = hashlib.sha256(json.dumps({
+        'book_type': book_type,
+        'viewport_width': VIEWPORT_WIDTH,
+        'viewport_height': VIEWPORT_HEIGHT,
+        'device_scale_factor': DEVICE_SCALE_FACTOR,
+        'render_version': RENDER_VERSION,
+        'output_settings': output_settings,
+    }, sort_keys=True).encode())
+    for css_file_path in sorted(css_file_paths):
+        common_hash.update(css_file_path.encode())
+        common_hash.update(read_file(css_file_path))
+
+    song_hashes = {}
+    for songnumber, file_path in songnumber_file_pairs:
+        song_hash = common_hash.copy()
+        song_hash.update(read_file(file_path.split('#')[0]))
+        song_hashes[songnumber] = song_hash.hexdigest()
+    return song_hashes
+
+
+def get_file_sha256(file_path, chunk_size=64 * 1024):
+    """Return hex sha256 of the file at file_path, read in chunks of chunk_size bytes"""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def write_text_atomic(text, file_path):
+    """Write text to file_path through a temporary file which then replaces it,
+    so the sender never reads a partially written file.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), prefix='.tmp-')
+    try:
+        # mkstemp creates files readable only by the owner. Use the mode open() would create.
+        os.chmod(tmp_path, 0o666 & ~umask)
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(text)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_manifest(output_dir):
+    """Return song hashes of images in output_dir from the last run: {songnumber: hash}"""
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+    if not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except ValueError:
+        return {}
+    return {int(songnumber): song_hash for songnumber, song_hash in manifest.get('songs', {}).items()}
+
+
+def write_manifest(output_dir, song_hashes):
+    """Write song hashes of images in output_dir"""
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+    write_text_atomic(json.dumps(
+        {'songs': {str(songnumber): song_hashes[songnumber] for songnumber in sorted(song_hashes)}},
+        indent=4), manifest_path)
 
-    browser = await pyppeteer.launch()
+
+def get_changed_songnumbers(output_dir, song_hashes, old_song_hashes, extension='png'):
+    """Return songnumbers whose image is missing or whose hash changed since the last run"""
+    return [
+        songnumber for songnumber, song_hash in song_hashes.items()
+        if old_song_hashes.get(songnumber) != song_hash
+        or not os.path.isfile(os.path.join(output_dir, f'{songnumber}.{extension}'))
+    ]
+
+
+def remove_orphan_images(output_dir, songnumbers):
+    """Remove song images in output_dir which are not of given songnumbers"""
+    for file_name in os.listdir(output_dir):
+        match = re.fullmatch(r'(\d+)\.(png|jpg|webp)', file_name)
+        if match and int(match.group(1)) not in songnumbers:
+            print(f'    Removing image {file_name}')
+            os.remove(os.path.join(output_dir, file_name))
+
+
+def remove_other_formats(output_dir, songnumbers, extension):
+    """Remove images of given songnumbers saved by earlier runs in a different format"""
+    for songnumber in songnumbers:
+        for other_extension in set(IMAGE_FORMATS.values()) - {extension}:
+            file_path = os.path.join(output_dir, f'{songnumber}.{other_extension}')
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+
+
+def update_catalogue(catalogue_path, book, lang, output_dir, songnumbers, changed_songnumbers=()):
+    """Record the images of songnumbers in output_dir in the lyrics catalogue read by the sender:
+        {
+            "HV": {
+                "en": {
+                    "1": {"file": "HV-en/1.png", "size": 123456, "sha256": "...", "file_id": "AgACAgUAAx..."},
+                    ...
+                }
+            }
+        }
+    File paths are relative to the catalogue. file_id(telegram) is set by the sender and kept while the image is unchanged.
+    Images of other books/languages are left as they are.
+    """
+    catalogue = {}
+    if os.path.isfile(catalogue_path):
+        try:
+            with open(catalogue_path) as catalogue_file:
+                catalogue = json.load(catalogue_file)
+        except ValueError:
+            catalogue = {}
+    old_songs = catalogue.get(book, {}).get(lang, {})
+
+    songs = {}
+    for songnumber in sorted(songnumbers):
+        file_path = None
+        for extension in sorted(set(IMAGE_FORMATS.values())):
+            image_path = os.path.join(output_dir, f'{songnumber}.{extension}')
+            if os.path.isfile(image_path):
+                file_path = image_path
+                break
+        if not file_path:
+            continue
+        song = {
+            'file': os.path.relpath(file_path, os.path.dirname(os.path.abspath(catalogue_path))),
+            'size': os.path.getsize(file_path),
+        }
+        old_song = old_songs.get(str(songnumber), {})
+        if (songnumber not in changed_songnumbers
+                and old_song.get('file') == song['file'] and old_song.get('size') == song['size']):
+            # Image was not rendered again. Skip reading it.
+            song['sha256'] = old_song['sha256']
+        else:
+            song['sha256'] = get_file_sha256(file_path)
+        if old_song.get('file_id') and old_song.get('sha256') == song['sha256']:
+            song['file_id'] = old_song['file_id']
+        songs[str(songnumber)] = song
+
+    catalogue.setdefault(book, {})[lang] = songs
+    write_text_atomic(json.dumps(catalogue, indent=4, sort_keys=True), catalogue_path)
+    print(f'Catalogue: {len(songs)} songs of {book}-{lang} in {catalogue_path}')
+
+
+# Output formats: file extension and Pillow save options
+IMAGE_FORMATS = {
+    'png': 'png',  # Screenshot as taken by chromium
+    'png8': 'png',  # Palette png with --colors colors
+    'jpeg': 'jpg',
+    'webp': 'webp',
+}
+# Telegram photo limits. Telegram does not display photos wider than TELEGRAM_MAX_WIDTH anyway.
+TELEGRAM_MAX_WIDTH = 1280
+TELEGRAM_MAX_DIMENSIONS_SUM = 10000
+TELEGRAM_MAX_RATIO = 20
+
+
+def get_telegram_size(width, height, max_width=TELEGRAM_MAX_WIDTH):
+    """Return (width, height) scaled down to fit the telegram photo limits"""
+    scale = min(1, max_width / width, TELEGRAM_MAX_DIMENSIONS_SUM / (width + height))
+    return (max(round(width * scale), 1), max(round(height * scale), 1))
+
+
+def optimize_image(png_path, image_format, quality, max_width, colors=32):
+    """Convert screenshot at png_path to image_format fitting telegram limits.
+    Return (path of output image, size of png in bytes, size of output image in bytes)
+    Runs in a separate process.
+    """
+    from PIL import Image
+
+    png_size = os.path.getsize(png_path)
+    output_path = os.path.splitext(png_path)[0] + '.' + IMAGE_FORMATS[image_format]
+    with Image.open(png_path) as image:
+        image = image.convert('RGB')
+        size = get_telegram_size(image.width, image.height, max_width)
+        if max(size) / min(size) > TELEGRAM_MAX_RATIO:
+            print(f'    {png_path} is too long for telegram({size[0]}x{size[1]})')
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        tmp_path = output_path + '.tmp'
+        if image_format == 'png8':
+            # No dithering. Dither noise compresses badly.
+            image.quantize(colors=colors, dither=0).save(tmp_path, 'PNG', optimize=True)
+        elif image_format == 'jpeg':
+            image.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+        elif image_format == 'webp':
+            image.save(tmp_path, 'WEBP', quality=quality, method=6)
+        else:
+            image.save(tmp_path, 'PNG', optimize=True)
+    os.replace(tmp_path, output_path)
+    if output_path != png_path:
+        os.remove(png_path)
+    return (output_path, png_size, os.path.getsize(output_path))
+
+
+def optimize_images(output_dir, songnumbers, image_format, quality, max_width, colors=32, processes=None):
+    """Convert screenshots of songnumbers in output_dir in a process pool and print bytes saved"""
+    if not songnumbers:
+        return
+    png_paths = [os.path.join(output_dir, f'{songnumber}.png') for songnumber in sorted(songnumbers)]
+    print(f'Optimizing images to {image_format}')
+    total_png_size = total_output_size = 0
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for output_path, png_size, output_size in executor.map(
+                optimize_image,
+                png_paths,
+                repeat(image_format), repeat(quality), repeat(max_width), repeat(colors)):
+            total_png_size += png_size
+            total_output_size += output_size
+    saved_percent = 100 * (1 - total_output_size / total_png_size) if total_png_size else 0
+    print(f'    {total_png_size} bytes -> {total_output_size} bytes(saved {saved_percent:.1f}%)')
+
+
+async def new_page(browser):
+    """Open a new page in browser with viewport set for taking screenshots"""
     page = await browser.newPage()
-    viewport_width = 411
-    viewport_height = math.ceil((viewport_width / 9) * 16)  # 16:9 ratio
     await page.setViewport({
-        'width': viewport_width,
+        'width': VIEWPORT_WIDTH,
         'height': page.viewport['height'],
-        'deviceScaleFactor': 4  # Scale page 4x
+        'deviceScaleFactor': DEVICE_SCALE_FACTOR  # Scale page 4x
     })
+    return page
+
+
+async def save_image(page, book_type, songnumber, file_path, output_dir):
+    """Open html file of song in page and save its screenshot in output_dir"""
+    await page.goto(file_path)
+    if book_type == 'hv':
+        # Hide the [Index] link in HV
+        await page.evaluate('''
+            indexLink = document.querySelector('.indexlink')
+            if (indexLink) {
+                indexLink.style.display = 'none';
+            }
+        ''')
+    await page.evaluate(f'''
+        html = document.querySelector('html');
+        html.style.minHeight = '{VIEWPORT_HEIGHT}px';
+    ''')
+    body = await page.querySelector('html')
+    await body.screenshot(
+        path=os.path.join(output_dir, f'{songnumber}.png'),
+        type='png'
+    )
+
+
+async def get_images(book_type, songnumber_file_pairs, output_dir, workers=1, browsers=1, retries=2):
+    """Use pyppeteer to take screenshots of html files and save them in output_dir
+
+    workers: Number of pages taking screenshots concurrently
+    browsers: Number of browser processes the pages are spread over
+    retries: Number of times a song is tried again on pyppeteer NetworkError/TimeoutError
+    Return list of songnumbers which could not be saved
+    """
+    if not songnumber_file_pairs:
+        return []
+    browser_list = [await pyppeteer.launch() for _ in range(max(browsers, 1))]
 
     songs_count = len(songnumber_file_pairs)
-    print(f'Saving images to: {output_dir}')
+    song_queue = asyncio.Queue()
     for index, pair in enumerate(songnumber_file_pairs, start=1):
-        (songnumber, file_path) = pair
-        print(f'    Saving Song: {index}/{songs_count}')
-        await page.goto(file_path)
-        if book_type == 'hv':
-            # Hide the [Index] link in HV
-            await page.evaluate('''
-                indexLink = document.querySelector('.indexlink')
-                if (indexLink) {
-                    indexLink.style.display = 'none';
-                }
-            ''')
-        await page.evaluate(f'''
-            html = document.querySelector('html');
-            html.style.minHeight = '{viewport_height}px';
-        ''')
-        body = await page.querySelector('html')
-        await body.screenshot(
-            path=os.path.join(output_dir, f'{songnumber}.png'),
-            type='png'
-        )
-    await browser.close()
+        song_queue.put_nowait((index, pair))
+
+    # Progress is reported in song order, even though songs finish out of order
+    done_indexes = {}
+    next_report_index = 1
+    failed_songnumbers = []
+
+    def report_done(index, songnumber, saved):
+        nonlocal next_report_index
+        done_indexes[index] = (songnumber, saved)
+        while next_report_index in done_indexes:
+            report_songnumber, report_saved = done_indexes[next_report_index]
+            if report_saved:
+                print(f'    Saving Song: {next_report_index}/{songs_count}')
+            else:
+                print(f'    Failed Song: {next_report_index}/{songs_count}(song {report_songnumber})')
+            next_report_index += 1
+
+    async def close_page(page):
+        """Close page. Errors are ignored, e.g. if the page crashed."""
+        try:
+            await page.close()
+        except Exception as exc:
+            print(f'    Closing page failed: {exc}')
+
+    async def worker(browser):
+        page = await new_page(browser)
+        while not song_queue.empty():
+            index, (songnumber, file_path) = song_queue.get_nowait()
+            saved = False
+            for try_ind in range(retries + 1):
+                try:
+                    await save_image(page, book_type, songnumber, file_path, output_dir)
+                    saved = True
+                    break
+                except (pyppeteer.errors.NetworkError, pyppeteer.errors.TimeoutError) as exc:
+                    print(f'    Song {songnumber} failed(try {try_ind + 1}): {exc}')
+                    await close_page(page)
+                    page = await new_page(browser)
+            if not saved:
+                failed_songnumbers.append(songnumber)
+            report_done(index, songnumber, saved)
+        await close_page(page)
+
+    print(f'Saving images to: {output_dir}')
+    try:
+        await asyncio.gather(*[
+            worker(browser_list[worker_ind % len(browser_list)])
+            for worker_ind in range(max(workers, 1))
+        ])
+    finally:
+        for browser in browser_list:
+            await browser.close()
+
+    if failed_songnumbers:
+        print(f"Failed songs: {', '.join(map(str, sorted(failed_songnumbers)))}")
+    return failed_songnumbers
 
 
 if __name__ == '__main__':
@@ -111,33 +561,98 @@ if __name__ == '__main__':
     epub_file_path = args.file
     output_dir = args.output_dir
 
-    # Create temporary directory
-    epub_extract_dir = tempfile.mkdtemp()
+    zip_ref = None
+    epub_extract_dir = None
+    epub_server = None
     try:
-        with ZipFile(epub_file_path, 'r') as zip_ref:
+        zip_ref = ZipFile(epub_file_path, 'r')
+        if args.extract:
+            # Create temporary directory
+            epub_extract_dir = tempfile.mkdtemp()
             zip_ref.extractall(epub_extract_dir)
+            base_url = 'file://' + epub_extract_dir + '/'
+        else:
+            # Serve files to the browser straight from the epub
+            epub_server = EpubServer(zip_ref)
+            base_url = epub_server.start()
+
+        def read_epub_file(file_path):
+            return zip_ref.read(unquote(file_path))
 
         songnumbers_index_file_filter = [file
-                                         for file in os.listdir(epub_extract_dir)
-                                         if file.endswith('index-songnumbers.html')]
+                                         for file in zip_ref.namelist()
+                                         if '/' not in file and file.endswith('index-songnumbers.html')]
 
         if not songnumbers_index_file_filter:
             raise Exception('Songnumber Index file not found!')
 
-        songnumbers_index_file_path = os.path.join(epub_extract_dir, songnumbers_index_file_filter[0])
-        songnumber_file_pairs = get_songnumber_file_pairs(songnumbers_index_file_path)
+        songnumber_file_pairs = get_songnumber_file_pairs(read_epub_file(songnumbers_index_file_filter[0]))
         songnumber_file_pairs_full_url = [
                                             (
                                                 pair[0],
-                                                'file://' + os.path.join(epub_extract_dir, pair[1])
+                                                base_url + pair[1]
                                             ) for pair in songnumber_file_pairs
                                          ]
 
         if not os.path.isdir(output_dir):
             os.makedirs(output_dir, exist_ok=True)
 
-        asyncio.get_event_loop().run_until_complete(get_images(book_type, songnumber_file_pairs_full_url, output_dir))
+        # Only render songs which changed since the last run
+        css_file_paths = [file for file in zip_ref.namelist() if file.endswith('.css')]
+        output_settings = None
+        if args.format != 'png':
+            output_settings = {
+                'format': args.format,
+                'quality': args.quality,
+                'max_width': args.max_width,
+                'colors': args.colors,
+            }
+        extension = IMAGE_FORMATS[args.format]
+        song_hashes = get_song_hashes(
+            book_type, songnumber_file_pairs, read_epub_file, css_file_paths, output_settings)
+        old_song_hashes = read_manifest(output_dir)
+        selected_songnumbers = args.songs if args.songs is not None else set(song_hashes)
+        changed_songnumbers = set(get_changed_songnumbers(
+            output_dir, song_hashes, {} if args.force else old_song_hashes, extension))
+        changed_songnumbers &= selected_songnumbers
+        print(f'Songs changed: {len(changed_songnumbers)}/{len(selected_songnumbers & set(song_hashes))}')
+        remove_orphan_images(output_dir, song_hashes)
+
+        failed_songnumbers = asyncio.get_event_loop().run_until_complete(get_images(
+            book_type,
+            [pair for pair in songnumber_file_pairs_full_url if pair[0] in changed_songnumbers],
+            output_dir,
+            workers=args.workers, browsers=args.browsers, retries=args.retries))
+
+        rendered_songnumbers = changed_songnumbers - set(failed_songnumbers)
+        if output_settings:
+            optimize_images(
+                output_dir, rendered_songnumbers,
+                args.format, args.quality, args.max_width, args.colors)
+        remove_other_formats(output_dir, rendered_songnumbers, extension)
+
+        # Failed songs are left out of the manifest so that they are rendered next time.
+        # Songs which were not selected keep their old hash.
+        manifest_song_hashes = {}
+        for songnumber, song_hash in song_hashes.items():
+            if songnumber in selected_songnumbers and songnumber not in failed_songnumbers:
+                manifest_song_hashes[songnumber] = song_hash
+            elif songnumber not in selected_songnumbers and songnumber in old_song_hashes:
+                manifest_song_hashes[songnumber] = old_song_hashes[songnumber]
+        write_manifest(output_dir, manifest_song_hashes)
+
+        if args.lang:
+            update_catalogue(
+                args.catalogue, book_type.upper(), args.lang, output_dir,
+                song_hashes, changed_songnumbers=rendered_songnumbers)
+        else:
+            print('Catalogue not updated. Language is not known, use --lang.')
 
     finally:
-        # Delete temporary directory
-        shutil.rmtree(epub_extract_dir)
+        if epub_server:
+            epub_server.stop()
+        if zip_ref:
+            zip_ref.close()
+        if epub_extract_dir:
+            # Delete temporary directory
+            shutil.rmtree(epub_extract_dir)
@@ -1,35 +1,161 @@
+import os
 import json
+import time
 import traceback
 
-import requests
+from requests.exceptions import HTTPError
+
+from http_session import create_session
+from metrics import metrics
+from multipart_encoder import MultipartEncoder
+from rate_limiter import RateLimiter
+
+
+class TelegramError(HTTPError):
+    """Error response of the bot api. Its message is the description sent by telegram."""
+    pass
+
+
+def get_error(response_json):
+    """Return (description, retry_after) of an error response of the bot api:
+        {"ok": false, "error_code": 429, "description": "Too Many Requests: retry after 5", "parameters": {"retry_after": 5}}
+    """
+    if not isinstance(response_json, dict):
+        return (None, None)
+    retry_after = (response_json.get('parameters') or {}).get('retry_after')
+    return (response_json.get('description'), retry_after)
+
+
+def get_local_uri(media):
+    """Return file:// uri of the file object media if it is a file on disk, else None.
+    A local bot api server(started with --local) reads such files itself.
+    """
+    path = getattr(media, 'name', None)
+    if isinstance(media, str) or not isinstance(path, str) or not os.path.isfile(path):
+        return None
+    return 'file://' + os.path.abspath(path)
 
 
 class TelegramBot:
-    """Send audio as message"""
+    """Send audio as message
+
+    Requests wait their turn in the rate limiter, which keeps them within telegram's limits.
+    If telegram still answers '429 Too Many Requests', the chat is paused for the requested
+    `retry_after` seconds and only that request is sent again.
+
+    Files are streamed to the bot api by MultipartEncoder instead of being read into memory.
+    With a local bot api server(https://github.com/tdlib/telegram-bot-api started with --local)
+    on the same machine, `local_mode` sends files which are on disk by their path(file://...),
+    so they are not uploaded at all and are not limited to 50 MB.
+    """
 
-    def __init__(self, bot_token):
+    def __init__(self, bot_token, session=None, timeout=15, upload_timeout=300, rate_limiter=None, max_retries=5,
+                 api_url='https://api.telegram.org', local_mode=False):
+        """
+        session: requests Session whose connection pool is used for all requests
+        timeout: Timeout in seconds of requests which do not upload files
+        upload_timeout: Timeout in seconds of requests which upload files
+        rate_limiter: RateLimiter shared by all requests. Default allows 30 requests per second, 1 per chat.
+        max_retries: Times a request is sent again after '429 Too Many Requests'
+        api_url: Base url of the bot api
+        local_mode: Send files on disk by their path. Only for a local bot api server started with --local.
+        """
         self.bot_token = bot_token
+        self.api_url = api_url.rstrip('/')
+        self.session = session or create_session()
+        self.timeout = timeout
+        self.upload_timeout = upload_timeout
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.local_mode = local_mode
+
+    def _post(self, method, data, files=None):
+        """Call given bot api method"""
+        with metrics.span('telegram_request', method=method, upload=bool(files)) as span:
+            span['chat_id'] = data.get('chat_id')
+            return self._post_retrying(method, data, files, span)
+
+    def _post_retrying(self, method, data, files, span):
+        """Call given bot api method. Wait for the rate limiter and send again after '429 Too Many Requests'."""
+        url = f'{self.api_url}/bot{self.bot_token}/{method}'
+        timeout = self.upload_timeout if files else self.timeout
+        chat_id = data.get('chat_id')
+        # Files are read again from their start if the request is retried
+        file_positions = {name: file.tell() for name, file in (files or {}).items()}
+        # Files which can not be rewound(e.g. AudioRelay) can be sent only once
+        can_retry = all(getattr(file, 'seekable', lambda: True)() for file in (files or {}).values())
+        for try_ind in range(self.max_retries + 1):
+            wait_time = self.rate_limiter.reserve(chat_id)
+            span['wait_seconds'] = round(span.get('wait_seconds', 0) + wait_time, 3)
+            span['tries'] = try_ind + 1
+            if wait_time:
+                time.sleep(wait_time)
+            for name, position in file_positions.items():
+                files[name].seek(position)
+            if files:
+                body = MultipartEncoder(data, files)
+                if body.len is not None:
+                    span['bytes'] = body.len
+                response = self.session.post(
+                    url,
+                    data=body,
+                    headers={'Content-Type': body.content_type},
+                    timeout=timeout
+                )
+            else:
+                response = self.session.post(
+                    url,
+                    data=data,
+                    timeout=timeout
+                )
+            if response.ok:
+                return response.json()['result']
+            try:
+                description, retry_after = get_error(response.json())
+            except ValueError:
+                description = retry_after = None
+            if response.status_code != 429 or retry_after is None:
+                break
+            # Later requests wait too, also if this one is not sent again
+            self.rate_limiter.pause(chat_id, retry_after)
+            if try_ind == self.max_retries or not can_retry:
+                break
+            print(f'Telegram {method}: retry after {retry_after} seconds', flush=True)
+            metrics.add('telegram_retries', method=method)
+        raise TelegramError(
+            f'{response.status_code} {description or response.reason} for {method}', response=response)
+
+    @staticmethod
+    def get_file_id(message):
+        """Return file_id of the audio/photo of a sent message"""
+        if 'audio' in message:
+            return message['audio']['file_id']
+        # Last photo size is the original one
+        return message['photo'][-1]['file_id']
+
+    def _add_input_file(self, name, media, data, files):
+        """Add media to request. media is either a byte stream to upload or file_id of an uploaded file.
+        In local mode, files on disk are sent by their path.
+        """
+        if self.local_mode:
+            media = get_local_uri(media) or media
+        if isinstance(media, str):
+            data[name] = media
+        else:
+            files[name] = media
 
     def send_message(self, text, chat_id, parse_mode=None):
-        """Send a text message"""
-        url = f'https://api.telegram.org/bot{self.bot_token}/sendMessage'
+        """Send a text message. Return the sent message."""
         data = {
             'chat_id': chat_id,
             'text': text,
             'parse_mode': parse_mode,
         }
-        response = requests.post(
-            url,
-            data=data
-        )
-        response.raise_for_status()
+        return self._post('sendMessage', data)
 
     def send_audio(self, audio_stream, chat_id, caption=None, title=None, parse_mode=None, performer=None):
-        """Send given audio byte stream to given chat_id"""
-        url = f'https://api.telegram.org/bot{self.bot_token}/sendAudio'
-        files = {
-            'audio': audio_stream,
-        }
+        """Send given audio byte stream(or file_id) to given chat_id. Return the sent message."""
+        files = {}
         data = {
             'chat_id': chat_id,
             'caption': caption,
@@ -37,50 +163,41 @@ class TelegramBot:
             'parse_mode': parse_mode,
             'performer': performer
         }
-        response = requests.post(
-            url,
-            files=files,
-            data=data
-        )
-        response.raise_for_status()
+        self._add_input_file('audio', audio_stream, data, files)
+        return self._post('sendAudio', data, files=files)
 
     def send_photo(self, photo_stream, chat_id, caption=None, parse_mode=None):
-        """Send given photo byte stream to given chat_id"""
-        url = f'https://api.telegram.org/bot{self.bot_token}/sendPhoto'
-        files = {
-            'photo': photo_stream,
-        }
+        """Send given photo byte stream(or file_id) to given chat_id. Return the sent message."""
+        files = {}
         data = {
             'chat_id': chat_id,
             'caption': caption,
             'parse_mode': parse_mode,
         }
-        response = requests.post(
-            url,
-            files=files,
-            data=data
-        )
-        response.raise_for_status()
+        self._add_input_file('photo', photo_stream, data, files)
+        return self._post('sendPhoto', data, files=files)
 
     def send_media_group(self, media_list, chat_id):
-        """Send given list of photos given chat_id"""
-        url = f'https://api.telegram.org/bot{self.bot_token}/sendMediaGroup'
+        """Send given list of photos(byte streams or file_ids) given chat_id.
+        Return list of the sent messages.
+        """
         files = {}
         data = {
             'chat_id': chat_id,
             'media': [],
         }
         for index, media in enumerate(media_list):
-            attach_id = f'media_{index}'
+            if self.local_mode:
+                media = get_local_uri(media) or media
+            if isinstance(media, str):
+                media_ref = media
+            else:
+                attach_id = f'media_{index}'
+                media_ref = f'attach://{attach_id}'
+                files[attach_id] = media
             data['media'].append({
                 'type': 'photo',
-                'media': f'attach://{attach_id}',
+                'media': media_ref,
             })
-            files[attach_id] = media
         data['media'] = json.dumps(data['media'])
-        response = requests.post(
-            url,
-            files=files,
-            data=data
-        )
-        response.raise_for_status()
+        return self._post('sendMediaGroup', data, files=files)
@@ -0,0 +1,40 @@
+import os
+import json
+
+from file_utils import dump_json_atomic
+
+
+class TokenStore():
+    """Simple JSON file to cache the OIDC token data of the BMM login.
+
+    The data is the `oidc` entry which BMM keeps in localStorage.
+    File format:
+    {
+        "access_token": "...",
+        "refresh_token": "...",
+        "expires_at": 1575270000,
+        ...
+    }
+    """
+
+    def __init__(self, token_file):
+        """Load token data from token file if it exists"""
+        self.token_filename = token_file
+        self.token_data = None
+
+        if os.path.isfile(self.token_filename):
+            try:
+                with open(self.token_filename) as token_file:
+                    self.token_data = json.load(token_file)
+            except ValueError:
+                # Corrupt cache. Behave as if there is no cached token.
+                self.token_data = None
+
+    def get_token_data(self):
+        """Return cached token data or None"""
+        return self.token_data
+
+    def set_token_data(self, token_data):
+        """Set token data and write it to the token file atomically, readable only by the owner"""
+        self.token_data = token_data
+        dump_json_atomic(token_data, self.token_filename, mode=0o600)
@@ -0,0 +1,165 @@
+import sqlite3
+import threading
+from datetime import datetime
+
+from metrics import metrics
+
+SONG_BOOKS = {
+    'herrens_veier': 'HV',
+    'mandelblomsten': 'MB',
+}
+
+
+def get_track_record(track, lang):
+    """Return compact record of a BMM track:
+        {
+            'id': 1234,
+            'lang': 'en',
+            'day': '2019-11-25',
+            'published_at': '2019-11-25T04:00:51+01:00',
+            'title': 'Track title',
+            'url': 'audio_url',
+            'size': 12345678,  # Bytes. None if not known
+            'duration': 301.5,  # Seconds. None if not known
+            'song_book': 'HV',  # [HV|MB|...] or None
+            'song_number': 123,  # or None
+        }
+    """
+    audio_file = {}
+    media = track.get('media')
+    if media and media[0].get('files'):
+        audio_file = media[0]['files'][0]
+
+    song_book = song_number = None
+    if track.get('rel'):
+        rel_song = track['rel'][0]
+        song_book = rel_song.get('name')
+        song_number = rel_song.get('id')
+    if song_book and song_number:
+        song_book = SONG_BOOKS.get(song_book, song_book.replace('_', ' ').title())
+    else:
+        song_book = song_number = None
+
+    published_at = track.get('published_at') or ''
+    return {
+        'id': track.get('id'),
+        'lang': lang,
+        # 2019-01-01T04:00:51+01:00 -> 2019-01-01
+        'day': published_at[:10],
+        'published_at': published_at,
+        'title': track.get('title'),
+        'url': audio_file.get('url'),
+        'size': audio_file.get('size'),
+        'duration': audio_file.get('duration'),
+        'song_book': song_book,
+        'song_number': song_number,
+    }
+
+
+class TrackCatalogue:
+    """SQLite catalogue of the tracks of the podcast, kept between runs.
+
+    Every track listed by BMM is stored once as a compact record(see get_track_record) and the
+    raw JSON is dropped. Records are indexed by day and by song, so tracks of some days or of a song
+    are found without going through all tracks.
+
+    Tables:
+        tracks(lang, id, day, published_at, title, url, size, duration, song_book, song_number)
+        synced(lang, since, until)
+            All tracks of lang published from day `since` are in the catalogue, as listed by BMM on day `until`.
+            Only tracks published after that need to be listed again(see get_sync_day).
+    """
+
+    columns = ['id', 'lang', 'day', 'published_at', 'title', 'url', 'size', 'duration', 'song_book', 'song_number']
+
+    def __init__(self, db_file):
+        """Open db file and create tables if needed"""
+        self.db_filename = db_file
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.db_filename, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self._lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS tracks ('
+                'lang TEXT, id INTEGER, day TEXT, published_at TEXT, title TEXT, url TEXT, '
+                'size INTEGER, duration REAL, song_book TEXT, song_number INTEGER, '
+                'PRIMARY KEY (lang, id))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS tracks_day ON tracks (day, lang)')
+            # Song books are matched case insensitively(see get_song_days)
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS tracks_song ON tracks (song_book COLLATE NOCASE, song_number)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS synced (lang TEXT PRIMARY KEY, since TEXT, until TEXT)')
+
+    def add_tracks(self, lang, tracks, since=None):
+        """Add tracks(as listed by BMM) of lang to the catalogue and return their records in the same order.
+        since: Day('YYYY-MM-DD', '' for all days) from which tracks contains all tracks of lang up to now.
+               Tracks of lang from that day which are not in tracks(e.g. removed from BMM) are removed.
+        """
+        records = [get_track_record(track, lang) for track in tracks]
+        placeholders = ', '.join('?' * len(self.columns))
+        with metrics.span('db_write', table='tracks'), self._lock, self.connection:
+            if since is not None:
+                self.connection.execute('DELETE FROM tracks WHERE lang = ? AND day >= ?', (lang, since))
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO tracks ({', '.join(self.columns)}) VALUES ({placeholders})",
+                [[record[column] for column in self.columns] for record in records])
+            if since is not None:
+                self._set_synced(lang, since)
+        return records
+
+    def _set_synced(self, lang, since):
+        row = self.connection.execute('SELECT since, until FROM synced WHERE lang = ?', (lang,)).fetchone()
+        # Extend the synced days if the new ones join them
+        if row is not None and since <= row['until']:
+            since = min(since, row['since'])
+        today = datetime.now().strftime('%Y-%m-%d')
+        self.connection.execute(
+            'INSERT OR REPLACE INTO synced (lang, since, until) VALUES (?, ?, ?)', (lang, since, today))
+
+    def get_sync_day(self, lang, since):
+        """Return day from which tracks of lang must be listed(and added) to have all tracks since given day.
+        That is the day of the last listing if the catalogue already has all tracks since given day.
+        """
+        with self._lock:
+            row = self.connection.execute('SELECT since, until FROM synced WHERE lang = ?', (lang,)).fetchone()
+        if row is not None and row['since'] <= since:
+            return row['until']
+        return since
+
+    def get_tracks(self, langs=None, from_day=None, to_day=None):
+        """Return records of given days(default all) and langs(default all) by day, like AsyncFraKaareSender.get_new_tracks:
+            {'2019-11-25': {'en': record, 'nb': record}, ...}
+        The latest track of a day is returned if a language has several.
+        """
+        conditions = []
+        params = []
+        if from_day:
+            conditions.append('day >= ?')
+            params.append(from_day)
+        if to_day:
+            conditions.append('day <= ?')
+            params.append(to_day)
+        if langs is not None:
+            conditions.append(f"lang IN ({', '.join('?' * len(langs))})")
+            params.extend(langs)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        with self._lock:
+            rows = self.connection.execute(
+                f'SELECT * FROM tracks {where} ORDER BY day, lang, published_at DESC', params).fetchall()
+        tracks = {}
+        for row in rows:
+            tracks.setdefault(row['day'], {}).setdefault(row['lang'], dict(row))
+        return tracks
+
+    def get_song_days(self, song_book, song_number, langs=None):
+        """Return days(oldest first) of tracks of langs(default all) with given song, e.g. ('HV', 12)"""
+        with self._lock:
+            rows = self.connection.execute(
+                'SELECT DISTINCT day, lang FROM tracks WHERE song_book = ? COLLATE NOCASE AND song_number = ?',
+                (song_book, song_number)).fetchall()
+        return sorted({row['day'] for row in rows if langs is None or row['lang'] in langs})
+
+    def close(self):
+        self.connection.close()